@@ -0,0 +1,1110 @@
+"""Замеры производительности API библиотеки
+
+Запуск:
+    python benchmark.py pool --books 100 --requests 2000
+    python benchmark.py bulk --books 100000
+    python benchmark.py load --clients 50 200 1000
+    python benchmark.py search --books 1000000 --requests 500
+    python benchmark.py checkout --requests 5000 --copies 100 --writers 8
+    python benchmark.py metrics --requests 2000
+    python benchmark.py suite --books 10000 --readers 2000 --loans 20000 --requests 5000 --concurrency 20 --output base.json
+    python benchmark.py suite --books 10000 --readers 2000 --loans 20000 --requests 5000 --concurrency 20 --baseline base.json --threshold 0.2
+    python benchmark.py workers --workers 1 2 4 8 --books 10000 --requests 20000 --concurrency 16
+    python benchmark.py serialize --rows 10000 --requests 200
+    python benchmark.py groupcommit --requests 5000 --concurrency 64 --window 2 --group-rows 100
+    python benchmark.py history --books 100000 --readers 100000 --loans 10000000 --requests 2000
+    python benchmark.py archive --books 10000 --readers 10000 --loans 1000000 --batch-size 200
+    python benchmark.py events --subscribers 5000 --requests 200
+    python benchmark.py backup --books 100000 --readers 100000 --loans 2000000 --concurrency 4 --budget-ms 50
+
+С --baseline результат сравнивается с сохраненным прогоном: при росте p50/p95
+или падении пропускной способности (throughput_rps) больше чем на --threshold скрипт
+завершается с кодом 1.
+"""
+import argparse
+import ast
+import asyncio
+import json
+import os
+import random
+import re
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def percentile(values, p):
+    """Перцентиль p (0-100) по отсортированному списку значений"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies):
+    """Сводка по задержкам в миллисекундах"""
+    ms = [v * 1000 for v in latencies]
+    return {
+        "requests": len(ms),
+        "mean_ms": round(statistics.fmean(ms), 3) if ms else 0.0,
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p95_ms": round(percentile(ms, 95), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+    }
+
+
+def prepare_database(books):
+    """Создать временную базу и заполнить её синтетическими книгами"""
+    fd, path = tempfile.mkstemp(suffix=".db", prefix="library_bench_")
+    os.close(fd)
+    os.environ["LIBRARY_DB_PATH"] = path
+
+    import library
+
+    library.migrate(path)
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO Authors (name, bio) VALUES ('Автор', '')")
+    conn.execute("INSERT INTO Genres (name, description) VALUES ('Жанр', '')")
+    conn.executemany(
+        "INSERT INTO Books (title, author_id, genre_id, isbn, publication_year, available_copies) VALUES (?, 1, 1, ?, 2000, 3)",
+        ((f"Книга {i}", f"isbn-{i}") for i in range(books)),
+    )
+    conn.commit()
+    conn.close()
+    return library, path
+
+
+def remove_database(path):
+    """Удалить временную базу вместе с файлами WAL"""
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def measure(client, url, requests, concurrency):
+    """Выполнить requests GET-запросов и вернуть задержки каждого"""
+    def one(_):
+        start = time.perf_counter()
+        response = client.get(url)
+        elapsed = time.perf_counter() - start
+        assert response.status_code == 200, response.text
+        return elapsed
+
+    if concurrency <= 1:
+        return [one(i) for i in range(requests)]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(one, range(requests)))
+
+
+def bench_pool(args):
+    """Сравнение /books/ со свежим соединением на запрос и с пулом соединений"""
+    from fastapi.testclient import TestClient
+
+    library, path = prepare_database(args.books)
+
+    class FreshConnections:
+        """Поведение до пула: новое соединение на каждый запрос"""
+
+        def acquire(self):
+            return sqlite3.connect(path, check_same_thread=False)
+
+        def release(self, conn):
+            conn.close()
+
+    results = {}
+    with TestClient(library.app) as client:
+        measure(client, "/books/", args.warmup, 1)
+
+        pooled = library.db.read_pool
+        library.db.read_pool = FreshConnections()
+        results["before"] = summarize(measure(client, "/books/", args.requests, args.concurrency))
+        library.db.read_pool = pooled
+
+        results["after"] = summarize(measure(client, "/books/", args.requests, args.concurrency))
+
+    remove_database(path)
+    return results
+
+
+def bench_bulk(args):
+    """Массовая загрузка args.books книг через bulk_insert"""
+    library, path = prepare_database(0)
+    records = [
+        {"title": f"Книга {i}", "author_id": 1, "genre_id": 1, "isbn": f"bulk-{i}", "publication_year": 2000}
+        for i in range(args.books)
+    ]
+
+    conn = sqlite3.connect(path)
+    start = time.perf_counter()
+    result = library.bulk_insert(conn, "books", records)
+    elapsed = time.perf_counter() - start
+    conn.close()
+
+    remove_database(path)
+    return {
+        "rows": args.books,
+        "inserted": result["inserted"],
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(args.books / elapsed),
+    }
+
+
+async def run_clients(client, url, clients, requests_per_client):
+    """Запустить clients параллельных клиентов, каждый выполняет requests_per_client запросов"""
+    latencies = []
+
+    async def one_client():
+        for _ in range(requests_per_client):
+            start = time.perf_counter()
+            response = await client.get(url)
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.text
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_client() for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+    result = summarize(latencies)
+    result["throughput_rps"] = round(len(latencies) / elapsed, 1)
+    return result
+
+
+def bench_load(args):
+    """Нагрузочное сравнение: асинхронный /books/ против синхронного обработчика в пуле потоков Starlette"""
+    import httpx
+
+    library, path = prepare_database(args.books)
+
+    def books_sync():
+        # Прежняя схема: синхронный обработчик, блокирующий поток Starlette на время запроса к базе
+        conn = library.pool.acquire()
+        try:
+            rows = conn.execute(
+                "SELECT book_id, title, author_id, genre_id, isbn, publication_year, available_copies "
+                "FROM Books ORDER BY book_id LIMIT ?", (library.DEFAULT_PAGE_SIZE,)
+            ).fetchall()
+        finally:
+            library.pool.release(conn)
+        return [{"book_id": b[0], "title": b[1], "author_id": b[2], "genre_id": b[3], "isbn": b[4],
+                 "publication_year": b[5], "available_copies": b[6]} for b in rows]
+
+    library.app.add_api_route("/bench/books-sync", books_sync, methods=["GET"])
+
+    async def run():
+        results = {}
+        async with library.lifespan(library.app):
+            transport = httpx.ASGITransport(app=library.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                await run_clients(client, "/books/", 10, args.warmup // 10 or 1)
+                for clients in args.clients:
+                    results[str(clients)] = {
+                        "sync": await run_clients(client, "/bench/books-sync", clients, args.requests_per_client),
+                        "async": await run_clients(client, "/books/", clients, args.requests_per_client),
+                    }
+        return results
+
+    try:
+        return asyncio.run(run())
+    finally:
+        remove_database(path)
+
+
+SYLLABLES = [
+    "ка", "ли", "мо", "ро", "ва", "не", "сто", "пре", "ду", "зи", "ёл", "ша", "тро", "гу", "бе",
+    "ям", "ско", "ми", "жа", "фе", "хо", "це", "чу", "щи", "эр", "ю", "ог", "ус", "лин", "дар",
+]
+
+
+def random_word(rng):
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+
+def bench_search(args):
+    """Задержка /search на каталоге из args.books книг со случайными названиями"""
+    from fastapi.testclient import TestClient
+
+    library, path = prepare_database(0)
+    rng = random.Random(42)
+    vocabulary = [random_word(rng) for _ in range(50000)]
+
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO Authors (name, bio) VALUES (?, ?)", (
+        (f"{rng.choice(vocabulary).title()} {rng.choice(vocabulary).title()}", " ".join(rng.sample(vocabulary, 8)))
+        for _ in range(max(1, args.books // 20))
+    ))
+    library.bulk_insert(conn, "books", [
+        {"title": " ".join(rng.sample(vocabulary, 3)), "author_id": rng.randint(1, max(1, args.books // 20)),
+         "genre_id": 1, "isbn": f"search-{i}", "publication_year": 2000}
+        for i in range(args.books)
+    ])
+    conn.close()
+
+    queries = [rng.choice(vocabulary)[:rng.randint(3, 5)] for _ in range(50)]
+    queries += [f"{rng.choice(vocabulary)} {rng.choice(vocabulary)[:3]}" for _ in range(50)]
+
+    with TestClient(library.app) as client:
+        measure(client, f"/search?q={queries[0]}", args.warmup, 1)
+        latencies = []
+        for i in range(args.requests):
+            latencies += measure(client, f"/search?q={queries[i % len(queries)]}", 1, 1)
+
+    remove_database(path)
+    return {"books": args.books, "search": summarize(latencies)}
+
+
+def bench_checkout(args):
+    """Стресс-тест выдачи: args.requests параллельных выдач одной книги через несколько независимых писателей
+
+    Каждый писатель - отдельный Database со своим пулом соединений, поэтому они конкурируют
+    за блокировку SQLite так же, как разные процессы. В конце все выданные копии возвращаются.
+    """
+    library, path = prepare_database(0)
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "INSERT INTO Books (title, author_id, genre_id, isbn, publication_year, available_copies) "
+        "VALUES ('Популярная книга', 1, 1, 'stress', 2000, ?)", (args.copies,)
+    )
+    conn.execute("INSERT INTO Readers (first_name, last_name, email) VALUES ('Стресс', 'Тест', 'stress@example.com')")
+    conn.commit()
+    book_id = conn.execute("SELECT book_id FROM Books WHERE isbn = 'stress'").fetchone()[0]
+
+    async def run():
+        writers = [library.Database(library.ConnectionPool(path, size=2), read_workers=1) for _ in range(args.writers)]
+        outcomes = {}
+        latencies = []
+
+        async def attempt(i):
+            start = time.perf_counter()
+            result = await library.create_book_loan(
+                book_id, 1, "2025-01-01", "2025-01-15", db=writers[i % len(writers)]
+            )
+            latencies.append(time.perf_counter() - start)
+            key = "issued" if "loan_id" in result else result["error"]
+            outcomes[key] = outcomes.get(key, 0) + 1
+            return result.get("loan_id")
+
+        start = time.perf_counter()
+        loan_ids = await asyncio.gather(*(attempt(i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - start
+
+        returns = await asyncio.gather(*(
+            library.return_book(loan_id, db=writers[loan_id % len(writers)]) for loan_id in loan_ids if loan_id
+        ))
+        for writer in writers:
+            writer.close()
+
+        result = summarize(latencies)
+        result["throughput_rps"] = round(args.requests / elapsed, 1)
+        result["outcomes"] = outcomes
+        result["returned"] = sum(1 for r in returns if "message" in r)
+        return result
+
+    try:
+        result = asyncio.run(run())
+        loans = conn.execute("SELECT COUNT(*) FROM BookLoans WHERE book_id = ?", (book_id,)).fetchone()[0]
+        available = conn.execute("SELECT available_copies FROM Books WHERE book_id = ?", (book_id,)).fetchone()[0]
+        result["copies"] = args.copies
+        result["loans_created"] = loans
+        result["available_after_returns"] = available
+        result["oversold"] = loans > args.copies
+    finally:
+        conn.close()
+        remove_database(path)
+    return result
+
+
+def bench_metrics(args):
+    """Накладные расходы метрик: /books/ с выключенными и включенными метриками
+
+    В выключенном прогоне отключается и журнал медленных запросов, иначе каждый запрос к базе
+    все равно замеряется.
+    """
+    from fastapi.testclient import TestClient
+
+    library, path = prepare_database(args.books)
+    results = {}
+    audit_enabled = library.audit.enabled
+    with TestClient(library.app) as client:
+        measure(client, "/books/", args.warmup, 1)
+
+        library.metrics.enabled = library.audit.enabled = False
+        results["disabled"] = summarize(measure(client, "/books/", args.requests, args.concurrency))
+        library.metrics.enabled, library.audit.enabled = True, audit_enabled
+        results["enabled"] = summarize(measure(client, "/books/", args.requests, args.concurrency))
+
+    results["overhead_p50_ms"] = round(results["enabled"]["p50_ms"] - results["disabled"]["p50_ms"], 3)
+    remove_database(path)
+    return results
+
+
+TEST_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data.txt")
+
+
+def load_templates(path=TEST_DATA_PATH):
+    """Строки INSERT из test_data.txt по таблицам, таблицы вне схемы (Users) пропускаются"""
+    import library
+
+    known = {table for table, *_ in library.BULK_TABLES.values()} | {"BookLoans"}
+    text = open(path, encoding="utf-8").read()
+    templates = {}
+    for table, columns, values in re.findall(r"INSERT INTO (\w+) \(([^)]*)\) VALUES\s*(.*?\));", text, re.S):
+        if table not in known:
+            continue
+        rows = ast.literal_eval("[" + re.sub(r"\bNULL\b", "None", values) + "]")
+        names = [c.strip() for c in columns.split(",")]
+        templates[table] = [dict(zip(names, row)) for row in rows]
+    return templates
+
+
+def generate_dataset(library, path, books, readers, loans, seed):
+    """Заполнить базу синтетическими данными по образцу test_data.txt
+
+    Записи размножаются из шаблонов с уникальными ISBN и email; открытые выдачи
+    уменьшают available_copies, как это сделал бы POST /book-loans/.
+    """
+    rng = random.Random(seed)
+    templates = load_templates()
+    authors = max(len(templates["Authors"]), books // 10)
+
+    def copy(kind, count, make):
+        table = library.BULK_TABLES[kind][0]
+        return [make(i, dict(templates[table][i % len(templates[table])])) for i in range(count)]
+
+    def author(i, row):
+        if i >= len(templates["Authors"]):
+            row["name"] = f"{row['name']} {i}"
+        return row
+
+    def book(i, row):
+        row.update(title=f"{row['title']} (том {i})", isbn=f"{row['isbn']}-{i}", author_id=rng.randint(1, authors))
+        return row
+
+    def reader(i, row):
+        local, domain = row["email"].split("@")
+        row["email"] = f"{local}+{i}@{domain}"
+        return row
+
+    conn = sqlite3.connect(path)
+    library.bulk_insert(conn, "authors", copy("authors", authors, author))
+    library.bulk_insert(conn, "genres", copy("genres", len(templates["Genres"]), lambda i, row: row))
+    book_rows = copy("books", books, book)
+    library.bulk_insert(conn, "books", book_rows)
+    library.bulk_insert(conn, "readers", copy("readers", readers, reader))
+
+    copies = [row["available_copies"] for row in book_rows]
+    loan_rows = []
+    for i in range(loans if books and readers else 0):
+        row = templates["BookLoans"][i % len(templates["BookLoans"])]
+        book_id = rng.randint(1, books)
+        return_date = row["return_date"]
+        if return_date is None:
+            if copies[book_id - 1] == 0:
+                return_date = row["due_date"]
+            else:
+                copies[book_id - 1] -= 1
+        loan_rows.append((book_id, rng.randint(1, readers), row["loan_date"], row["due_date"], return_date))
+    conn.executemany(
+        "INSERT INTO BookLoans (book_id, reader_id, loan_date, due_date, return_date) VALUES (?, ?, ?, ?, ?)", loan_rows
+    )
+    conn.executemany(
+        "UPDATE Books SET available_copies = ? WHERE book_id = ?",
+        ((left, i + 1) for i, (left, row) in enumerate(zip(copies, book_rows)) if left != row["available_copies"]),
+    )
+    conn.commit()
+    conn.close()
+    return {"authors": authors, "genres": len(templates["Genres"]), "books": books, "readers": readers, "loans": loans}
+
+
+SUITE_MIX = {
+    "GET /books/": 30,
+    "GET /books/{book_id}": 10,
+    "GET /authors/": 5,
+    "GET /readers/": 5,
+    "GET /book-loans/": 10,
+    "POST /readers/": 5,
+    "POST /books/": 5,
+    "POST /book-loans/": 18,
+    "PUT /book-loans/{loan_id}/return": 12,
+}
+
+
+def parse_mix(text):
+    """Смесь запросов из строки вида "GET /books/=50,POST /book-loans/=50" """
+    if not text:
+        return dict(SUITE_MIX)
+    mix = {}
+    for part in text.split(","):
+        endpoint, _, weight = part.rpartition("=")
+        if endpoint.strip() not in SUITE_MIX:
+            raise SystemExit(f"Неизвестный эндпоинт в смеси: {endpoint.strip()}")
+        mix[endpoint.strip()] = float(weight)
+    return mix
+
+
+REGRESSION_LATENCIES = ("p50_ms", "p95_ms")
+
+
+def compare_results(current, baseline, threshold, prefix=""):
+    """Регрессии относительно базового прогона: рост p50/p95 или падение throughput_rps больше threshold
+
+    Среднее и p99 не сравниваются: на коротких прогонах они слишком шумные.
+    """
+    regressions = []
+    for key, base in baseline.items():
+        value = current.get(key) if isinstance(current, dict) else None
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(base, dict) and isinstance(value, dict):
+            regressions += compare_results(value, base, threshold, name)
+        elif not isinstance(base, (int, float)) or not isinstance(value, (int, float)) or base <= 0:
+            continue
+        elif key in REGRESSION_LATENCIES and value > base * (1 + threshold):
+            regressions.append({"metric": name, "baseline": base, "current": value, "change": round(value / base - 1, 3)})
+        elif key == "throughput_rps" and value < base * (1 - threshold):
+            regressions.append({"metric": name, "baseline": base, "current": value, "change": round(value / base - 1, 3)})
+    return regressions
+
+
+def bench_suite(args):
+    """Смешанная нагрузка на library.app в процессе: чтение списков, создание, выдача и возврат
+
+    Каждый клиент выбирает эндпоинты по весам смеси из своего генератора случайных чисел,
+    поэтому при одном --seed последовательность запросов повторяется от прогона к прогону.
+    """
+    import httpx
+
+    library, path = prepare_database(0)
+    dataset = generate_dataset(library, path, args.books, args.readers, args.loans, args.seed)
+    mix = parse_mix(args.mix)
+    endpoints, weights = list(mix), list(mix.values())
+
+    conn = sqlite3.connect(path)
+    open_loans = [row[0] for row in conn.execute("SELECT loan_id FROM BookLoans WHERE return_date IS NULL")]
+    conn.close()
+    counter = iter(range(10 ** 9))
+
+    def request_for(endpoint, rng):
+        n = next(counter)
+        if endpoint == "GET /books/":
+            return "GET", "/books/", {"after_id": rng.randint(0, max(0, args.books - 100)), "limit": 50}
+        if endpoint == "GET /books/{book_id}":
+            return "GET", f"/books/{rng.randint(1, max(1, args.books))}", None
+        if endpoint == "GET /authors/":
+            return "GET", "/authors/", {"limit": 50}
+        if endpoint == "GET /readers/":
+            return "GET", "/readers/", {"after_id": rng.randint(0, max(0, args.readers - 50)), "limit": 50}
+        if endpoint == "GET /book-loans/":
+            return "GET", "/book-loans/", {"reader_id": rng.randint(1, max(1, args.readers)), "active_only": True}
+        if endpoint == "POST /readers/":
+            return "POST", "/readers/", {"first_name": "Нагрузка", "last_name": "Тест", "email": f"suite-{n}@example.com"}
+        if endpoint == "POST /books/":
+            return "POST", "/books/", {"title": f"Новая книга {n}", "author_id": 1, "genre_id": 1,
+                                       "isbn": f"suite-{n}", "publication_year": 2024, "available_copies": 3}
+        if endpoint == "POST /book-loans/":
+            return "POST", "/book-loans/", {"book_id": rng.randint(1, max(1, args.books)),
+                                            "reader_id": rng.randint(1, max(1, args.readers)),
+                                            "loan_date": "2025-01-01", "due_date": "2025-01-15"}
+        if open_loans:
+            loan_id = open_loans.pop(rng.randrange(len(open_loans)))
+            return "PUT", f"/book-loans/{loan_id}/return", None
+        return None
+
+    stats = {endpoint: {"latencies": [], "errors": 0, "rejected": 0} for endpoint in endpoints}
+
+    async def one_client(client, index, requests, record):
+        rng = random.Random(args.seed * 1000 + index)
+        for _ in range(requests):
+            endpoint = rng.choices(endpoints, weights)[0]
+            prepared = request_for(endpoint, rng)
+            if prepared is None:
+                continue
+            method, url, params = prepared
+            start = time.perf_counter()
+            response = await client.request(method, url, params=params)
+            elapsed = time.perf_counter() - start
+            if not record:
+                continue
+            stats[endpoint]["latencies"].append(elapsed)
+            if response.status_code != 200:
+                stats[endpoint]["errors"] += 1
+                continue
+            body = response.json()
+            if isinstance(body, dict) and "error" in body:
+                # Бизнес-отказ (например, "Книга недоступна") - ожидаемый исход, а не сбой
+                stats[endpoint]["rejected"] += 1
+            elif endpoint == "POST /book-loans/":
+                open_loans.append(body["loan_id"])
+
+    async def run():
+        clients = max(1, args.concurrency)
+        async with library.lifespan(library.app):
+            transport = httpx.ASGITransport(app=library.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                await asyncio.gather(*(one_client(client, -1 - i, args.warmup // clients, False) for i in range(clients)))
+                start = time.perf_counter()
+                await asyncio.gather(*(
+                    one_client(client, i, args.requests // clients + (i < args.requests % clients), True)
+                    for i in range(clients)
+                ))
+                return time.perf_counter() - start
+
+    try:
+        elapsed = asyncio.run(run())
+    finally:
+        remove_database(path)
+
+    results = {"dataset": dataset, "mix": mix, "concurrency": args.concurrency, "seed": args.seed, "endpoints": {}}
+    total = []
+    for endpoint, data in stats.items():
+        result = summarize(data["latencies"])
+        result["throughput_rps"] = round(len(data["latencies"]) / elapsed, 1)
+        result["errors"] = data["errors"]
+        result["rejected"] = data["rejected"]
+        results["endpoints"][endpoint] = result
+        total += data["latencies"]
+    results["total"] = summarize(total)
+    results["total"]["throughput_rps"] = round(len(total) / elapsed, 1)
+    results["total"]["seconds"] = round(elapsed, 3)
+    return results
+
+
+def bench_serialize(args):
+    """Процессорное время на ответ /books/ из args.rows строк: обобщенный путь FastAPI, json и orjson"""
+    from fastapi.testclient import TestClient
+
+    os.environ["LIBRARY_MAX_PAGE_SIZE"] = str(max(args.rows, 1000))
+    library, path = prepare_database(args.rows)
+
+    async def books_generic(limit: int = 100):
+        # Прежний путь: список словарей, который FastAPI пропускает через jsonable_encoder и json
+        rows = await library.db.fetch_all(
+            "SELECT book_id, title, author_id, genre_id, isbn, publication_year, available_copies "
+            "FROM Books ORDER BY book_id LIMIT ?", (limit,)
+        )
+        return [{"book_id": b[0], "title": b[1], "author_id": b[2], "genre_id": b[3], "isbn": b[4],
+                 "publication_year": b[5], "available_copies": b[6]} for b in rows]
+
+    library.app.add_api_route("/bench/books-generic", books_generic, methods=["GET"])
+
+    def run(client, url):
+        measure(client, url, max(1, args.warmup // 10), 1)
+        cpu = time.process_time()
+        latencies = measure(client, url, args.requests, 1)
+        result = summarize(latencies)
+        result["cpu_ms_per_request"] = round((time.process_time() - cpu) * 1000 / args.requests, 3)
+        return result
+
+    fast = library.orjson
+    results = {"rows": args.rows, "orjson_installed": fast is not None}
+    with TestClient(library.app) as client:
+        results["generic"] = run(client, f"/bench/books-generic?limit={args.rows}")
+        library.orjson = None
+        results["raw_json"] = run(client, f"/books/?limit={args.rows}")
+        library.orjson = fast
+        if fast is not None:
+            results["raw_orjson"] = run(client, f"/books/?limit={args.rows}")
+
+    remove_database(path)
+    return results
+
+
+def bench_groupcommit(args):
+    """Создание читателей args.concurrency параллельными клиентами: фиксация каждой вставки против групповой
+
+    Каждая 50-я вставка повторяет email предыдущей: такие вызовы должны получить свою ошибку,
+    не мешая остальным вставкам группы.
+    """
+    library, path = prepare_database(0)
+
+    async def run(db, tag):
+        semaphore = asyncio.Semaphore(max(1, args.concurrency))
+        latencies = []
+        outcomes = {"created": 0, "errors": 0}
+
+        async def one(i):
+            email = f"{tag}-{i - 1 if i % 50 == 49 else i}@example.com"
+            async with semaphore:
+                start = time.perf_counter()
+                result = await library.create_reader("Групповая", "Фиксация", email, db=db)
+                latencies.append(time.perf_counter() - start)
+            outcomes["created" if "reader_id" in result else "errors"] += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - start
+        db.close()
+
+        result = summarize(latencies)
+        result.update(outcomes)
+        result["expected_errors"] = args.requests // 50
+        result["inserts_per_second"] = round(outcomes["created"] / elapsed, 1)
+        return result
+
+    results = {}
+    try:
+        for synchronous in ("FULL", "NORMAL"):
+            pragmas = dict(library.PRAGMAS, synchronous=synchronous)
+            for mode, window in (("single", 0), ("group", args.window / 1000)):
+                db = library.Database(library.ConnectionPool(path, size=2, pragmas=pragmas), read_workers=1,
+                                     group_window=window, group_size=args.group_rows)
+                results[f"{synchronous.lower()}_{mode}"] = asyncio.run(run(db, f"{synchronous}-{mode}"))
+    finally:
+        remove_database(path)
+    return results
+
+
+def fill_loans(path, loans, books, readers, chunk=1000000):
+    """Добавить loans возвращенных выдач за 2015-2024 годы одним INSERT ... SELECT на порцию
+
+    Строки порождает рекурсивный CTE внутри SQLite, поэтому 10 млн выдач не проходят через Python.
+    """
+    conn = sqlite3.connect(path)
+    for start in range(0, loans, chunk):
+        conn.execute(
+            """
+            INSERT INTO BookLoans (book_id, reader_id, loan_date, due_date, return_date)
+            WITH RECURSIVE n(i) AS (SELECT ?1 UNION ALL SELECT i + 1 FROM n WHERE i < ?2)
+            SELECT abs(random()) % ?3 + 1, abs(random()) % ?4 + 1,
+                   date('2015-01-01', '+' || (i * 3650 / ?5) || ' days'),
+                   date('2015-01-01', '+' || (i * 3650 / ?5 + 14) || ' days'),
+                   date('2015-01-01', '+' || (i * 3650 / ?5 + 10) || ' days')
+            FROM n
+            """,
+            (start, min(start + chunk, loans) - 1, books, readers, loans),
+        )
+        conn.commit()
+    conn.close()
+
+
+def bench_history(args):
+    """История выдач читателя и книги на таблице из args.loans выдач
+
+    "filter" - прежний способ, /book-loans/ с фильтром reader_id или book_id;
+    остальные варианты - новые /readers/{id}/loans и /books/{id}/loans, с диапазоном дат и без.
+    """
+    from fastapi.testclient import TestClient
+
+    library, path = prepare_database(0)
+    generate_dataset(library, path, args.books, args.readers, 0, args.seed)
+    start = time.perf_counter()
+    fill_loans(path, args.loans, args.books, args.readers)
+    results = {"books": args.books, "readers": args.readers, "loans": args.loans,
+               "fill_seconds": round(time.perf_counter() - start, 1)}
+
+    rng = random.Random(args.seed)
+
+    def urls(kind, ids):
+        year = rng.randint(2015, 2023)
+        item = rng.randint(1, ids)
+        return {
+            "filter": f"/book-loans/?{kind}_id={item}",
+            "history": f"/{kind}s/{item}/loans",
+            "history_year": f"/{kind}s/{item}/loans?date_from={year}-01-01&date_to={year}-12-31",
+        }
+
+    with TestClient(library.app) as client:
+        for kind, ids in (("reader", args.readers), ("book", args.books)):
+            latencies = {}
+            for _ in range(args.requests):
+                for variant, url in urls(kind, ids).items():
+                    start = time.perf_counter()
+                    response = client.get(url)
+                    latencies.setdefault(variant, []).append(time.perf_counter() - start)
+                    assert response.status_code == 200, response.text
+            results[kind] = {variant: summarize(values) for variant, values in latencies.items()}
+
+    conn = sqlite3.connect(path)
+    results["plans"] = {
+        column: [row[3] for row in conn.execute(
+            f"EXPLAIN QUERY PLAN SELECT loan_id, book_id, reader_id, loan_date, due_date, return_date "
+            f"FROM BookLoans WHERE {column} = 1 AND loan_id > 0 AND loan_date >= '2020-01-01' ORDER BY loan_id LIMIT 100"
+        )]
+        for column in ("reader_id", "book_id")
+    }
+    conn.close()
+    remove_database(path)
+    return results
+
+
+def bench_archive(args):
+    """Архивация args.loans возвращенных выдач и задержка вставок читателей, идущих параллельно с ней"""
+    library, path = prepare_database(0)
+    generate_dataset(library, path, args.books, args.readers, 0, args.seed)
+    fill_loans(path, args.loans, args.books, args.readers)
+
+    async def run():
+        db = library.Database(library.ConnectionPool(path, size=2), read_workers=1)
+        idle = []
+        during = []
+
+        async def writer(latencies, stop):
+            i = 0
+            while not stop():
+                start = time.perf_counter()
+                await library.create_reader("Архив", "Тест", f"archive-{len(idle)}-{i}@example.com", db=db)
+                latencies.append(time.perf_counter() - start)
+                i += 1
+                await asyncio.sleep(0.005)
+
+        started = time.perf_counter()
+        await writer(idle, lambda: time.perf_counter() - started > 1)
+
+        archiving = asyncio.ensure_future(library.archive_loans(db, 0, args.batch_size))
+        start = time.perf_counter()
+        await writer(during, archiving.done)
+        archived = await archiving
+        elapsed = time.perf_counter() - start
+        db.close()
+        return {
+            "archived": archived,
+            "seconds": round(elapsed, 2),
+            "rows_per_second": round(archived / elapsed),
+            "insert_idle": summarize(idle),
+            "insert_during_archive": summarize(during),
+        }
+
+    try:
+        result = asyncio.run(run())
+        conn = sqlite3.connect(path)
+        result["hot_rows_left"] = conn.execute("SELECT COUNT(*) FROM BookLoans").fetchone()[0]
+        conn.close()
+    finally:
+        remove_database(path)
+    result["batch_size"] = args.batch_size
+    return result
+
+
+WORKERS_MIX = {"GET /books/{book_id}": 60, "GET /books/": 25, "POST /readers/": 10, "POST /book-loans/": 5}
+
+
+def workers_client(base_url, index, requests, books, readers, seed, tag):
+    """Клиент замера воркеров (отдельный процесс): последовательные запросы по смеси WORKERS_MIX"""
+    import requests as http
+
+    rng = random.Random(seed * 1000 + index)
+    endpoints, weights = list(WORKERS_MIX), list(WORKERS_MIX.values())
+    latencies = {endpoint: [] for endpoint in endpoints}
+    errors = {endpoint: 0 for endpoint in endpoints}
+    session = http.Session()
+    for n in range(requests):
+        endpoint = rng.choices(endpoints, weights)[0]
+        if endpoint == "GET /books/{book_id}":
+            method, url, params = "GET", f"/books/{rng.randint(1, books)}", None
+        elif endpoint == "GET /books/":
+            method, url, params = "GET", "/books/", {"after_id": rng.randint(0, max(0, books - 50)), "limit": 50}
+        elif endpoint == "POST /readers/":
+            method, url, params = "POST", "/readers/", {"first_name": "Воркер", "last_name": "Тест",
+                                                        "email": f"workers-{tag}-{index}-{n}@example.com"}
+        else:
+            method, url, params = "POST", "/book-loans/", {"book_id": rng.randint(1, books),
+                                                           "reader_id": rng.randint(1, readers),
+                                                           "loan_date": "2025-01-01", "due_date": "2025-01-15"}
+        start = time.perf_counter()
+        response = session.request(method, base_url + url, params=params)
+        latencies[endpoint].append(time.perf_counter() - start)
+        body = response.json() if response.status_code == 200 else None
+        # "Книга недоступна" - обычный отказ; ошибкой считаются только сбои и занятая база
+        if body is None or (isinstance(body, dict) and body.get("error") not in (None, "Книга недоступна")):
+            errors[endpoint] += 1
+    return latencies, errors
+
+
+def start_server(path, workers, port, cpus):
+    """Запустить uvicorn с workers процессами, привязанный к cpus ядрам (если их хватает)"""
+    env = dict(os.environ, LIBRARY_DB_PATH=path, LIBRARY_WORKERS=str(workers))
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    pinned = available[:cpus] if len(available) >= cpus else None
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "library:app", "--port", str(port), "--workers", str(workers),
+         "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        preexec_fn=(lambda: os.sched_setaffinity(0, pinned)) if pinned else None,
+    )
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1)
+            return server, pinned is not None
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("Сервер не запустился")
+
+
+def bench_workers(args):
+    """Масштабирование по ядрам: uvicorn с 1, 2, 4, 8 воркерами над одной базой в режиме WAL
+
+    Сервер с N воркерами привязывается к N ядрам, нагрузку дают --concurrency клиентских процессов.
+    Если ядер на машине меньше N, сервер не привязывается, и это отмечается в результате.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    library, path = prepare_database(0)
+    dataset = generate_dataset(library, path, args.books, args.readers, args.loans, args.seed)
+    clients = max(1, args.concurrency)
+    results = {"dataset": dataset, "clients": clients, "cpus_available": os.cpu_count(), "workers": {}}
+
+    try:
+        for workers in args.workers:
+            port = 8100 + workers
+            server, pinned = start_server(path, workers, port, workers)
+            try:
+                base_url = f"http://127.0.0.1:{port}"
+                with ProcessPoolExecutor(max_workers=clients) as executor:
+                    def run(requests, tag):
+                        return list(executor.map(
+                            workers_client, [base_url] * clients, range(clients), [requests] * clients,
+                            [args.books] * clients, [args.readers] * clients, [args.seed] * clients, [tag] * clients,
+                        ))
+
+                    run(args.warmup // clients, f"{workers}-warmup")
+                    start = time.perf_counter()
+                    outcomes = run(args.requests // clients, str(workers))
+                    elapsed = time.perf_counter() - start
+            finally:
+                server.terminate()
+                server.wait()
+
+            result = {"pinned_to_cores": pinned, "endpoints": {}}
+            total = []
+            for endpoint in WORKERS_MIX:
+                latencies = [v for client_latencies, _ in outcomes for v in client_latencies[endpoint]]
+                summary = summarize(latencies)
+                summary["throughput_rps"] = round(len(latencies) / elapsed, 1)
+                summary["errors"] = sum(client_errors[endpoint] for _, client_errors in outcomes)
+                result["endpoints"][endpoint] = summary
+                total += latencies
+            result["total"] = summarize(total)
+            result["total"]["throughput_rps"] = round(len(total) / elapsed, 1)
+            results["workers"][str(workers)] = result
+    finally:
+        remove_database(path)
+        if os.path.exists(path + "-lock"):
+            os.remove(path + "-lock")
+    return results
+
+
+def process_usage(pid):
+    """Резидентная память (КиБ) и процессорное время (с) процесса по /proc"""
+    with open(f"/proc/{pid}/status") as f:
+        rss = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return rss, (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def bench_events(args):
+    """Поток /events: память и процессор сервера на args.subscribers простаивающих подписчиков
+    и задержка доставки события loan_created всем подписчикам сразу
+    """
+    library, path = prepare_database(args.books)
+    port = 8099
+    server, _ = start_server(path, 1, port, 1)
+
+    async def run():
+        received = {}
+        delivered = asyncio.Event()
+
+        async def subscriber(ready):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"GET /events HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n\r\n".encode())
+            await reader.readuntil(b"retry:")
+            ready.set_result(None)
+            event = None
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        return
+                    if line.startswith(b"event:"):
+                        event = line[6:].strip()
+                    elif line.startswith(b"data:") and event == b"loan_created":
+                        loan_id = json.loads(line[5:])["loan_id"]
+                        received[loan_id] = received.get(loan_id, 0) + 1
+                        if received[loan_id] == args.subscribers:
+                            delivered.set()
+            finally:
+                writer.close()
+
+        loop = asyncio.get_running_loop()
+        rss_before, _ = process_usage(server.pid)
+        readies = [loop.create_future() for _ in range(args.subscribers)]
+        tasks = [asyncio.ensure_future(subscriber(ready)) for ready in readies]
+        start = time.perf_counter()
+        await asyncio.gather(*readies)
+        connect_seconds = time.perf_counter() - start
+        rss_after, _ = process_usage(server.pid)
+
+        # Простой: сервер не должен тратить процессор на подключенных, но молчащих клиентов
+        _, cpu_before = process_usage(server.pid)
+        await asyncio.sleep(5)
+        _, cpu_after = process_usage(server.pid)
+
+        def post(url):
+            request = urllib.request.Request(url, method="POST")
+            return json.loads(urllib.request.urlopen(request).read())
+
+        latencies = []
+        base_url = f"http://127.0.0.1:{port}"
+        for i in range(args.requests):
+            delivered.clear()
+            start = time.perf_counter()
+            loan = await loop.run_in_executor(
+                None, post, f"{base_url}/book-loans/?book_id={i % args.books + 1}&reader_id=1&loan_date=2025-01-10&due_date=2025-01-24"
+            )
+            await delivered.wait()
+            latencies.append(time.perf_counter() - start)
+            await loop.run_in_executor(
+                None, lambda: urllib.request.urlopen(urllib.request.Request(f"{base_url}/book-loans/{loan['loan_id']}/return", method="PUT")).read()
+            )
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return {
+            "subscribers": args.subscribers,
+            "connect_seconds": round(connect_seconds, 2),
+            "server_rss_kib_per_subscriber": round((rss_after - rss_before) / args.subscribers, 1),
+            "server_cpu_idle_percent": round((cpu_after - cpu_before) / 5 * 100, 2),
+            "delivery_to_all": summarize(latencies),
+        }
+
+    try:
+        return asyncio.run(run())
+    finally:
+        server.terminate()
+        server.wait()
+        remove_database(path)
+
+
+def bench_backup(args):
+    """Задержка GET /books/ и GET /book-loans/ без копирования и во время онлайн-копии базы через /admin/backup"""
+    import requests as http
+
+    library, path = prepare_database(0)
+    dataset = generate_dataset(library, path, args.books, args.readers, 0, args.seed)
+    fill_loans(path, args.loans, args.books, args.readers)
+    backup_dir = tempfile.mkdtemp(prefix="library_backup_")
+    os.environ["LIBRARY_BACKUP_DIR"] = backup_dir
+    os.environ["LIBRARY_BACKUP_P99_MS"] = str(args.budget_ms)
+    port = 8098
+    server, _ = start_server(path, 1, port, 1)
+    base_url = f"http://127.0.0.1:{port}"
+    stop = False
+    samples = []
+
+    def client(index):
+        rng = random.Random(args.seed * 1000 + index)
+        session = http.Session()
+        while not stop:
+            if rng.random() < 0.5:
+                url, params = "/books/", {"after_id": rng.randint(0, max(0, args.books - 50)), "limit": 50}
+            else:
+                url, params = "/book-loans/", {"after_id": rng.randint(0, max(0, args.loans - 50)), "limit": 50}
+            start = time.perf_counter()
+            session.get(base_url + url, params=params)
+            samples.append((start, time.perf_counter() - start))
+
+    def window(start, end):
+        return summarize([latency for started, latency in samples if start <= started < end])
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            clients = [executor.submit(client, i) for i in range(args.concurrency)]
+            time.sleep(1)
+            idle_start = time.perf_counter()
+            time.sleep(5)
+            backup_start = time.perf_counter()
+            http.post(f"{base_url}/admin/backup", params={"compress": args.compress})
+            while True:
+                status = http.get(f"{base_url}/admin/backup").json()
+                if not status["running"]:
+                    break
+                time.sleep(0.2)
+            backup_end = time.perf_counter()
+            stop = True
+            for future in clients:
+                future.result()
+        size = os.path.getsize(status["target"]) if status["error"] is None else 0
+    finally:
+        server.terminate()
+        server.wait()
+        remove_database(path)
+        for name in os.listdir(backup_dir):
+            os.remove(os.path.join(backup_dir, name))
+        os.rmdir(backup_dir)
+    return {
+        "dataset": dataset,
+        "loans": args.loans,
+        "budget_p99_ms": args.budget_ms,
+        "backup": dict(status, size_mb=round(size / 2 ** 20, 1)),
+        "latency_idle": window(idle_start, backup_start),
+        "latency_during_backup": window(backup_start, backup_end),
+    }
+
+
+BENCHMARKS = {
+    "pool": bench_pool,
+    "bulk": bench_bulk,
+    "load": bench_load,
+    "search": bench_search,
+    "checkout": bench_checkout,
+    "metrics": bench_metrics,
+    "suite": bench_suite,
+    "workers": bench_workers,
+    "serialize": bench_serialize,
+    "groupcommit": bench_groupcommit,
+    "history": bench_history,
+    "archive": bench_archive,
+    "events": bench_events,
+    "backup": bench_backup,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности API библиотеки")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--books", type=int, default=100, help="количество книг в синтетической базе")
+    parser.add_argument("--requests", type=int, default=2000, help="количество запросов в замере")
+    parser.add_argument("--concurrency", type=int, default=1, help="количество параллельных клиентов")
+    parser.add_argument("--warmup", type=int, default=100, help="количество прогревочных запросов")
+    parser.add_argument("--clients", type=int, nargs="+", default=[50, 200, 1000],
+                        help="уровни параллельности для нагрузочного замера")
+    parser.add_argument("--copies", type=int, default=100, help="копий книги в стресс-тесте выдачи")
+    parser.add_argument("--writers", type=int, default=4, help="независимых писателей в стресс-тесте выдачи")
+    parser.add_argument("--requests-per-client", type=int, default=5, help="запросов на одного клиента")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="количество воркеров uvicorn в замере масштабирования")
+    parser.add_argument("--window", type=float, default=2, help="окно групповой фиксации, мс")
+    parser.add_argument("--group-rows", type=int, default=100, help="наибольшее число вставок в группе")
+    parser.add_argument("--batch-size", type=int, default=200, help="порция архивации выдач")
+    parser.add_argument("--budget-ms", type=float, default=50, help="бюджет p99 запросов во время резервного копирования")
+    parser.add_argument("--compress", action="store_true", help="сжимать резервную копию gzip")
+    parser.add_argument("--subscribers", type=int, default=1000, help="подписчиков потока событий")
+    parser.add_argument("--rows", type=int, default=10000, help="строк в ответе для замера сериализации")
+    parser.add_argument("--readers", type=int, default=100, help="количество читателей в синтетической базе")
+    parser.add_argument("--loans", type=int, default=200, help="количество выдач в синтетической базе")
+    parser.add_argument("--mix", help='веса эндпоинтов смешанной нагрузки, например "GET /books/=70,POST /book-loans/=30"')
+    parser.add_argument("--seed", type=int, default=42, help="зерно генератора данных и последовательности запросов")
+    parser.add_argument("--output", help="сохранить результат в JSON-файл")
+    parser.add_argument("--baseline", help="JSON-файл прошлого прогона для проверки регрессий")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое ухудшение относительно baseline")
+    args = parser.parse_args()
+
+    results = BENCHMARKS[args.benchmark](args)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            results["regressions"] = compare_results(results, json.load(f), args.threshold)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if results.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
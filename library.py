@@ -1,298 +1,3009 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends, Query, Request, Response
 import sqlite3
-from datetime import date
+import csv
+import glob
+import gzip
+import io
+import json
+import logging
+import re
+import queue
+import threading
+import asyncio
+import time
+import uuid
+import zlib
+from email.utils import formatdate, parsedate_to_datetime
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+from typing import Optional
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+import anyio.to_thread
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 import os
 
-app = FastAPI()
+try:
+    import orjson  # необязательный быстрый сериализатор JSON, без него используется json
+except ImportError:
+    orjson = None
 
-os.makedirs("static", exist_ok=True)
-app.mount("/static", StaticFiles(directory="static"), name="static")
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессная блокировка записи недоступна, остаются BEGIN IMMEDIATE и повторы
+    fcntl = None
 
-@app.get("/")
-def read_root():
-    return FileResponse("static/index.html")
+# Настройки базы данных (задаются через переменные окружения при запуске)
+DB_PATH = os.environ.get("LIBRARY_DB_PATH", "simple_library.db")
+POOL_SIZE = int(os.environ.get("LIBRARY_POOL_SIZE", "8"))
+POOL_TIMEOUT = float(os.environ.get("LIBRARY_POOL_TIMEOUT", "5"))
+JOURNAL_MODE = os.environ.get("LIBRARY_JOURNAL_MODE", "WAL")
+SYNCHRONOUS = os.environ.get("LIBRARY_SYNCHRONOUS", "NORMAL")
+CACHE_SIZE = int(os.environ.get("LIBRARY_CACHE_SIZE", "-16000"))  # отрицательное значение - размер в КиБ
+MMAP_SIZE = int(os.environ.get("LIBRARY_MMAP_SIZE", str(64 * 1024 * 1024)))
+BUSY_TIMEOUT_MS = int(os.environ.get("LIBRARY_BUSY_TIMEOUT_MS", "2000"))  # ожидание блокировки записи в SQLite
+BUSY_RETRIES = int(os.environ.get("LIBRARY_BUSY_RETRIES", "3"))  # повторы транзакции, если блокировка не получена
+READ_WORKERS = int(os.environ.get("LIBRARY_READ_WORKERS", str(max(1, POOL_SIZE - 1))))  # запись идет в одном отдельном потоке
+THREADPOOL_SIZE = int(os.environ.get("LIBRARY_THREADPOOL_SIZE", "40"))  # потоки Starlette для выгрузок и статики
+
+# Несколько процессов uvicorn над одним файлом базы (python library.py serve --workers N)
+WORKERS = int(os.environ.get("LIBRARY_WORKERS", "1"))
+MULTI_WORKER = WORKERS > 1
+READ_ONLY_READS = os.environ.get("LIBRARY_READ_ONLY", "1" if MULTI_WORKER else "0") == "1"  # чтение через mode=ro
+
+# Групповая фиксация небольших вставок: окно ожидания (0 - выключена) и наибольшее число вставок в группе.
+# Ответ отдается только после COMMIT группы, надежность по-прежнему задает LIBRARY_SYNCHRONOUS.
+GROUP_COMMIT_WINDOW = float(os.environ.get("LIBRARY_GROUP_COMMIT_MS", "0")) / 1000
+GROUP_COMMIT_SIZE = int(os.environ.get("LIBRARY_GROUP_COMMIT_ROWS", "100"))
+
+# Архив выдач: возвращенные больше ARCHIVE_AFTER_DAYS дней назад переносятся в BookLoansArchive
+# порциями по ARCHIVE_BATCH_SIZE строк; при ARCHIVE_INTERVAL > 0 (секунды) перенос идет по расписанию
+ARCHIVE_AFTER_DAYS = int(os.environ.get("LIBRARY_ARCHIVE_AFTER_DAYS", "365"))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("LIBRARY_ARCHIVE_BATCH_SIZE", "200"))
+ARCHIVE_INTERVAL = float(os.environ.get("LIBRARY_ARCHIVE_INTERVAL", "0"))
+
+# PRAGMA каждого соединения пула; дополнительные задаются строкой "temp_store=MEMORY;foreign_keys=ON"
+PRAGMAS = {
+    "journal_mode": JOURNAL_MODE,
+    "synchronous": SYNCHRONOUS,
+    "cache_size": CACHE_SIZE,
+    "mmap_size": MMAP_SIZE,
+    "busy_timeout": BUSY_TIMEOUT_MS,
+}
+PRAGMAS.update(
+    (name.strip(), value.strip())
+    for name, _, value in (item.partition("=") for item in os.environ.get("LIBRARY_PRAGMAS", "").split(";"))
+    if name.strip()
+)
+
+# Метрики в формате Prometheus (/metrics)
+METRICS_ENABLED = os.environ.get("LIBRARY_METRICS", "1") == "1"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Журнал медленных запросов: запрос дольше SLOW_QUERY_MS (0 - выключено) пишется с планом EXPLAIN QUERY PLAN
+# в логгер library.sql, а при заданном LIBRARY_SLOW_QUERY_LOG - еще и в файл. Время запросов и так
+# замеряют метрики, поэтому по умолчанию журнал включен вместе с ними, а при LIBRARY_METRICS=0 выключен.
+# PLAN_CHECK (режим разработки) проверяет план каждого запроса и запоминает полные просмотры таблиц
+SLOW_QUERY_MS = float(os.environ.get("LIBRARY_SLOW_QUERY_MS", "100" if METRICS_ENABLED else "0"))
+SLOW_QUERY_LOG = os.environ.get("LIBRARY_SLOW_QUERY_LOG")
+PLAN_CHECK = os.environ.get("LIBRARY_PLAN_CHECK", "0") == "1"
+
+# Постраничный вывод списков
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = int(os.environ.get("LIBRARY_MAX_PAGE_SIZE", "1000"))
+
+# Поля объектов в ответах списков и выгрузках - в порядке столбцов SELECT
+BOOK_COLUMNS = ("book_id", "title", "author_id", "genre_id", "isbn", "publication_year", "available_copies")
+BOOK_DETAILED_COLUMNS = (
+    "book_id", "title", "author_id", "author_name", "genre_id", "genre_name", "isbn", "publication_year", "available_copies"
+)
+READER_COLUMNS = ("reader_id", "first_name", "last_name", "email", "phone")
+LOAN_COLUMNS = ("loan_id", "book_id", "reader_id", "loan_date", "due_date", "return_date")
+
+# Кэш справочных данных (авторы, жанры, отдельные книги)
+RESPONSE_CACHE_SIZE = int(os.environ.get("LIBRARY_RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL = float(os.environ.get("LIBRARY_RESPONSE_CACHE_TTL", "60"))
+
+# Полнотекстовый поиск: для слишком общих запросов ранжируются только первые совпадения
+# (ответ тогда получает заголовок X-Search-Truncated)
+SEARCH_CANDIDATES = int(os.environ.get("LIBRARY_SEARCH_CANDIDATES", "2000"))
+
+# Потоковая выгрузка таблиц
+EXPORT_BATCH_SIZE = 1000
+# Выгрузки держат соединение, пока ответ передается клиенту, поэтому у них свой ограниченный пул
+EXPORT_CONNECTIONS = int(os.environ.get("LIBRARY_EXPORT_CONNECTIONS", "4"))
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+
+# Онлайн-копия базы: порция страниц за шаг backup API, наибольшая доля времени, которую копирование
+# может занимать, и бюджет p99 маршрутов BACKUP_WATCHED_ROUTES, при превышении которого доля урезается
+BACKUP_DIR = os.environ.get("LIBRARY_BACKUP_DIR", "backups")
+BACKUP_PAGES = int(os.environ.get("LIBRARY_BACKUP_PAGES", "256"))
+BACKUP_DUTY = float(os.environ.get("LIBRARY_BACKUP_DUTY", "0.5"))
+BACKUP_P99_BUDGET = float(os.environ.get("LIBRARY_BACKUP_P99_MS", "50")) / 1000
+BACKUP_WATCHED_ROUTES = (("GET", "/books/"), ("GET", "/book-loans/"))
+
+# Поток событий /events: пауза между комментариями-пингами и предел очереди медленного клиента
+EVENT_KEEPALIVE = float(os.environ.get("LIBRARY_EVENT_KEEPALIVE", "15"))
+EVENT_QUEUE_SIZE = int(os.environ.get("LIBRARY_EVENT_QUEUE_SIZE", "256"))
+# При нескольких воркерах события пересылаются через таблицу Events: как часто воркер ее опрашивает
+# и сколько последних событий в ней хранится
+EVENT_POLL_INTERVAL = float(os.environ.get("LIBRARY_EVENT_POLL_MS", "100")) / 1000
+EVENT_LOG_SIZE = int(os.environ.get("LIBRARY_EVENT_LOG_SIZE", "10000"))
+# Открытые потоки событий сами не завершаются, поэтому остановка сервера ждет их не дольше этого времени
+SHUTDOWN_TIMEOUT = float(os.environ.get("LIBRARY_SHUTDOWN_TIMEOUT", "5"))
+
+# Массовая загрузка: таблица, столбцы, обязательные поля и значения по умолчанию
+BULK_CHUNK_SIZE = 5000
+BULK_CACHE_GROUPS = {"authors": "authors", "genres": "genres", "books": "book", "readers": "readers"}
+BULK_TABLES = {
+    "authors": ("Authors", ["name", "bio"], {"name"}, {"bio": ""}),
+    "genres": ("Genres", ["name", "description"], {"name"}, {"description": ""}),
+    "books": (
+        "Books",
+        ["title", "author_id", "genre_id", "isbn", "publication_year", "available_copies"],
+        {"title", "author_id", "genre_id", "isbn", "publication_year"},
+        {"available_copies": 1},
+    ),
+    "readers": ("Readers", ["first_name", "last_name", "email", "phone"], {"first_name", "last_name", "email"}, {"phone": ""}),
+}
+
+
+class Metrics:
+    """Счетчики и гистограммы, которые отдаются в текстовом формате Prometheus"""
+
+    def __init__(self, enabled=METRICS_ENABLED, buckets=LATENCY_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * len(self.buckets) + [0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    def histogram(self, name, labels):
+        """Копия гистограммы (накопленные корзины, число, сумма) или None"""
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            return None if histogram is None else list(histogram)
+
+    def quantile(self, before, after, q):
+        """Верхняя граница корзины квантиля q по наблюдениям между снимками before и after; None без наблюдений"""
+        total = after[-2] - before[-2]
+        if total <= 0:
+            return None
+        for bound, count_after, count_before in zip(self.buckets, after, before):
+            if count_after - count_before >= q * total:
+                return bound
+        return float("inf")
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self, gauges=()):
+        """Текст для /metrics; gauges - пары (имя, метки, значение), снятые в момент запроса"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(value)) for key, value in self._histograms.items())
+
+        lines = []
+        described = set()
+
+        def header(name):
+            if name in self._help and name not in described:
+                kind, text = self._help[name]
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            header(name)
+            for bound, count in zip(self.buckets, histogram):
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {histogram[-2]}")
+            lines.append(f"{name}_count{self._labels(labels)} {histogram[-2]}")
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram[-1]}")
+        for name, labels, value in gauges:
+            header(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("library_http_requests_total", "counter", "HTTP-запросы по маршруту и коду ответа")
+metrics.describe("library_http_request_duration_seconds", "histogram", "Время обработки HTTP-запроса")
+metrics.describe("library_sql_statement_duration_seconds", "histogram", "Время выполнения SQL-запроса (execute)")
+metrics.describe("library_sql_fetch_seconds_total", "counter", "Время чтения строк результата SQL-запроса")
+metrics.describe("library_sql_rows_total", "counter", "Прочитанные или измененные строки по SQL-запросам")
+metrics.describe("library_pool_connections", "gauge", "Соединения пулов (запись, чтение, выгрузки) по состоянию")
+metrics.describe("library_cache_entries", "gauge", "Записи в кэше ответов")
+metrics.describe("library_cache_requests_total", "counter", "Обращения к кэшу ответов по результату")
+metrics.describe("library_db_errors_total", "counter", "Ошибки базы, которые обработчики вернули клиенту как error")
+metrics.describe("library_backup_running", "gauge", "Идет ли онлайн-копирование базы")
+metrics.describe("library_backup_pages", "gauge", "Страницы базы в текущем или последнем копировании")
+metrics.describe("library_backup_duration_seconds", "gauge", "Длительность текущего или последнего копирования")
+
+
+def statement_label(sql):
+    return " ".join(sql.split())[:200]
+
+
+class QueryAudit:
+    """Журнал медленных запросов и проверка планов на полный просмотр таблиц
+
+    План каждого текста запроса строится один раз. SCAN по виртуальной таблице (json_each, FTS5)
+    полным просмотром не считается; запрос, которому полный просмотр нужен по смыслу
+    (выгрузка, пересчет), помечается комментарием /* full scan */.
+    """
+
+    ALLOWED_SCAN = "/* full scan */"
+
+    def __init__(self, slow_ms=SLOW_QUERY_MS, check=PLAN_CHECK, log_path=SLOW_QUERY_LOG):
+        self.slow_seconds = slow_ms / 1000 if slow_ms > 0 else None
+        self.check = check
+        self.enabled = self.slow_seconds is not None or check
+        self.slow_queries = 0
+        self.scans = {}
+        self._checked = set()
+        self._lock = threading.Lock()
+        self.log = logging.getLogger("library.sql")
+        if log_path:
+            handler = logging.FileHandler(log_path, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.log.addHandler(handler)
+
+    @staticmethod
+    def plan(conn, sql, parameters):
+        """Строки плана EXPLAIN QUERY PLAN с отступом по вложенности"""
+        depth = {0: -1}
+        lines = []
+        for node, parent, _, detail in sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parameters):
+            depth[node] = depth.get(parent, -1) + 1
+            lines.append("  " * depth[node] + detail)
+        return lines
+
+    def inspect(self, conn, sql, parameters):
+        """Запомнить запрос, план которого просматривает таблицу целиком"""
+        if sql in self._checked:
+            return
+        with self._lock:
+            self._checked.add(sql)
+        if self.ALLOWED_SCAN in sql:
+            return
+        try:
+            plan = self.plan(conn, sql, parameters)
+        except sqlite3.Error:
+            # Служебные команды (PRAGMA, BEGIN, SAVEPOINT) плана не имеют
+            return
+        if any(self.full_scan(line.lstrip()) for line in plan):
+            with self._lock:
+                self.scans[statement_label(sql)] = plan
+
+    @staticmethod
+    def full_scan(detail):
+        # Подзапросы, константная строка и виртуальные таблицы просматриваются без чтения таблиц
+        return detail.startswith("SCAN ") and not (
+            detail.startswith(("SCAN CONSTANT ROW", "SCAN (subquery")) or "VIRTUAL TABLE" in detail
+        )
+
+    def slow(self, conn, sql, parameters, elapsed):
+        self.slow_queries += 1
+        try:
+            plan = self.plan(conn, sql, parameters) if parameters is not None else []
+        except sqlite3.Error:
+            plan = []
+        self.log.warning(
+            "Медленный запрос %.1f мс: %s%s",
+            elapsed * 1000, statement_label(sql), "".join("\n    " + line for line in plan),
+        )
+
+    def stats(self):
+        return {"slow_queries": self.slow_queries, "plan_check": self.check, "full_scans": len(self.scans)}
+
+
+audit = QueryAudit()
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Курсор, который замеряет время SQL-запросов и считает строки
+
+    Время запроса - это execute и все последующие fetch; при превышении порога запрос
+    один раз попадает в журнал медленных запросов.
+    """
+
+    statement = None
+    _query = None
+    _elapsed = None
+
+    def execute(self, sql, parameters=()):
+        if not (metrics.enabled or audit.enabled):
+            return super().execute(sql, parameters)
+        return self._timed(super().execute, sql, parameters, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not (metrics.enabled or audit.enabled):
+            return super().executemany(sql, seq_of_parameters)
+        # План строится по первому набору параметров, если он известен заранее
+        first = seq_of_parameters[0] if isinstance(seq_of_parameters, (list, tuple)) and seq_of_parameters else None
+        return self._timed(super().executemany, sql, seq_of_parameters, first)
+
+    def _timed(self, execute, sql, parameters, sample):
+        if audit.check and sample is not None:
+            audit.inspect(self.connection, sql, sample)
+        self.statement = (("statement", statement_label(sql)),)
+        self._query = (sql, sample)
+        self._elapsed = 0.0
+        start = time.perf_counter()
+        try:
+            return execute(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - start
+            if metrics.enabled:
+                metrics.observe("library_sql_statement_duration_seconds", self.statement, elapsed)
+                if self.rowcount > 0:
+                    metrics.inc("library_sql_rows_total", self.statement, self.rowcount)
+            self._spent(elapsed)
+
+    def _spent(self, elapsed):
+        if audit.slow_seconds is None or self._elapsed is None:
+            return
+        self._elapsed += elapsed
+        if self._elapsed >= audit.slow_seconds:
+            audit.slow(self.connection, *self._query, self._elapsed)
+            self._elapsed = None
+
+    def _fetched(self, rows, start):
+        if self.statement is None:
+            return
+        elapsed = time.perf_counter() - start
+        if metrics.enabled:
+            metrics.inc("library_sql_fetch_seconds_total", self.statement, elapsed)
+            if rows:
+                metrics.inc("library_sql_rows_total", self.statement, rows)
+        self._spent(elapsed)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(0 if row is None else 1, start)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(len(rows), start)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(len(rows), start)
+        return rows
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Соединение, все курсоры которого замеряют SQL-запросы"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # Connection.execute в CPython создает курсор в обход cursor(), поэтому переопределяем и его
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class MetricsMiddleware:
+    """ASGI-прослойка: число запросов и гистограмма задержек по маршрутам"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not metrics.enabled:
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            labels = (("method", scope["method"]), ("route", route.path if route is not None else "unmatched"))
+            metrics.inc("library_http_requests_total", labels + (("status", status),))
+            metrics.observe("library_http_request_duration_seconds", labels, time.perf_counter() - start)
+
+
+class ConnectionPool:
+    """Ограниченный пул соединений SQLite"""
+
+    def __init__(self, path, size=POOL_SIZE, timeout=POOL_TIMEOUT, pragmas=None, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        if pragmas is None:
+            # Режим журнала меняет только пишущее соединение, соединение mode=ro его лишь читает
+            pragmas = {k: v for k, v in PRAGMAS.items() if k != "journal_mode"} if read_only else PRAGMAS
+        self.pragmas = pragmas
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created = 0
+
+    def _connect(self):
+        path = f"file:{self.path}?mode=ro" if self.read_only else self.path
+        conn = sqlite3.connect(
+            path, timeout=self.timeout, check_same_thread=False, factory=InstrumentedConnection, uri=self.read_only
+        )
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def _is_healthy(self, conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        """Взять соединение из пула (или открыть новое, если лимит не исчерпан)"""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            conn = self._idle.get(timeout=self.timeout)
+
+        if not self._is_healthy(conn):
+            self._discard(conn)
+            return self.acquire()
+        return conn
+
+    def release(self, conn):
+        """Вернуть соединение в пул"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (sqlite3.Error, queue.Full):
+            self._discard(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def exhausted(self):
+        """Все соединения открыты и заняты: acquire будет ждать"""
+        return self._created >= self.size and self._idle.empty()
+
+    def stats(self):
+        return {"size": self.size, "open": self._created, "idle": self._idle.qsize()}
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+class WriteLock:
+    """Межпроцессная блокировка записи (flock на файле рядом с базой)
+
+    Потоки записи разных воркеров берут её по очереди, поэтому не ждут блокировку SQLite
+    в цикле busy_timeout и не получают "database is locked". Без fcntl блокировка пустая.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def acquire(self, blocking=True):
+        """Взять блокировку; при blocking=False вернуть False, если её держит другой владелец"""
+        if fcntl is None:
+            return True
+        if self._file is None:
+            self._file = open(self.path, "a")
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return False
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Database:
+    """Исполнитель запросов к базе: несколько потоков чтения и один поток записи
+
+    Если передан read_pool, чтение идет через его соединения (например, mode=ro),
+    а pool остается потоку записи. write_lock согласует запись между процессами.
+    При group_window > 0 вызовы transaction() фиксируются группами (см. _flush_group).
+    after_write(conn) вызывается после каждой записи, пока блокировка записи еще взята.
+    """
+
+    def __init__(self, pool, read_workers=READ_WORKERS, read_pool=None, write_lock=None,
+                 group_window=GROUP_COMMIT_WINDOW, group_size=GROUP_COMMIT_SIZE, after_write=None):
+        self.pool = pool
+        self.read_pool = read_pool or pool
+        self.write_lock = write_lock
+        self.after_write = after_write
+        self.group_window = group_window
+        self.group_size = group_size
+        self._readers = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="db-read")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        self._pending = []
+        self._pending_changed = threading.Condition()
+        self._flush_scheduled = False
+
+    def _call(self, pool, fn, args):
+        conn = pool.acquire()
+        try:
+            return fn(conn, *args)
+        finally:
+            pool.release(conn)
+
+    def _write(self, conn, fn, args):
+        try:
+            return fn(conn, *args)
+        finally:
+            if self.after_write is not None:
+                self.after_write(conn)
+
+    def _call_write(self, fn, args):
+        if self.write_lock is None:
+            return self._call(self.pool, self._write, (fn, args))
+        with self.write_lock:
+            return self._call(self.pool, self._write, (fn, args))
+
+    async def read(self, fn, *args):
+        """Выполнить fn(conn, *args) в потоке чтения, не блокируя цикл событий"""
+        return await asyncio.get_running_loop().run_in_executor(self._readers, self._call, self.read_pool, fn, args)
+
+    async def write(self, fn, *args):
+        """Выполнить fn(conn, *args) в единственном потоке записи"""
+        return await asyncio.get_running_loop().run_in_executor(self._writer, self._call_write, fn, args)
+
+    async def transaction(self, fn, *args):
+        """Выполнить fn(cursor, *args) в транзакции записи и вернуть её результат
+
+        Исключение fn (например, IntegrityError на повторный email) получает только этот вызов.
+        """
+        if not self.group_window:
+            return await self.write(lambda conn: write_transaction(conn, lambda cursor: fn(cursor, *args)))
+
+        future = Future()
+        with self._pending_changed:
+            self._pending.append((fn, args, future))
+            if not self._flush_scheduled:
+                self._flush_scheduled = True
+                self._writer.submit(self._flush_group)
+            elif len(self._pending) >= self.group_size:
+                self._pending_changed.notify()
+        return await asyncio.wrap_future(future)
+
+    def _flush_group(self):
+        # Поток записи ждет, пока наберется group_size вызовов или пройдет group_window,
+        # и фиксирует всю группу одним COMMIT
+        deadline = time.monotonic() + self.group_window
+        with self._pending_changed:
+            while len(self._pending) < self.group_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._pending_changed.wait(remaining)
+            batch = self._pending[:self.group_size]
+            del self._pending[:self.group_size]
+            if self._pending:
+                self._writer.submit(self._flush_group)
+            else:
+                self._flush_scheduled = False
+        try:
+            self._call_write(self._commit_group, (batch,))
+        except BaseException as e:
+            # Соединение или блокировку записи получить не удалось: _commit_group не запускался,
+            # и без этого вызовы группы ждали бы результата вечно
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _commit_group(self, conn, batch):
+        outcomes = []
+
+        def run_all(cursor):
+            outcomes.clear()
+            for fn, args, _ in batch:
+                # Точка сохранения на каждый вызов: ошибка одного не откатывает остальных
+                cursor.execute("SAVEPOINT item")
+                try:
+                    outcomes.append((fn(cursor, *args), None))
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO item")
+                    outcomes.append((None, e))
+                cursor.execute("RELEASE item")
+
+        try:
+            write_transaction(conn, run_all)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), (result, error) in zip(batch, outcomes):
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    async def fetch_all(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    def stats(self):
+        stats = {"write_pool": self.pool.stats()}
+        if self.read_pool is not self.pool:
+            stats["read_pool"] = self.read_pool.stats()
+        return stats
+
+    def close(self):
+        self._readers.shutdown()
+        self._writer.shutdown()
+        self.pool.close()
+        if self.read_pool is not self.pool:
+            self.read_pool.close()
+        if self.write_lock is not None:
+            self.write_lock.close()
+
+
+# Схема базы: версионные миграции, номер последней примененной хранится в PRAGMA user_version.
+# Миграции выполняются один раз при старте приложения (lifespan), а не при импорте модуля.
+# Шаги 2-4 идемпотентны: базы, созданные до появления миграций, могут уже содержать их объекты.
+
+def migration_create_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Authors (
+            author_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            bio TEXT
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Genres (
+            genre_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            description TEXT
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Books (
+            book_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            author_id INTEGER,
+            genre_id INTEGER,
+            isbn TEXT UNIQUE,
+            publication_year INTEGER,
+            available_copies INTEGER DEFAULT 1
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Readers (
+            reader_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            first_name TEXT NOT NULL,
+            last_name TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            phone TEXT
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS BookLoans (
+            loan_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER,
+            reader_id INTEGER,
+            loan_date DATE NOT NULL,
+            due_date DATE NOT NULL,
+            return_date DATE
+        )
+    ''')
+
+    # Индексы для фильтров списков
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_books_author ON Books (author_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_books_genre ON Books (genre_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_loans_reader_return ON BookLoans (reader_id, return_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_loans_book ON BookLoans (book_id)")
+
+    # Просроченные выдачи: в частичный индекс попадают только невозвращенные книги
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_loans_open_due ON BookLoans (due_date, reader_id, book_id)
+        WHERE return_date IS NULL
+    ''')
+
+
+def migration_normalize_loan_dates(cursor):
+    # Даты хранятся как TEXT, поэтому сравниваются строкой - приводим старые записи к ГГГГ-ММ-ДД
+    for column in ("loan_date", "due_date", "return_date"):
+        cursor.execute(f'''
+            UPDATE BookLoans
+            SET {column} = substr({column}, 7, 4) || '-' || substr({column}, 4, 2) || '-' || substr({column}, 1, 2)
+            WHERE {column} GLOB '[0-9][0-9].[0-9][0-9].[0-9][0-9][0-9][0-9]'
+        ''')
+        cursor.execute(f'''
+            UPDATE BookLoans SET {column} = substr({column}, 1, 10)
+            WHERE {column} GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]?*'
+        ''')
+
+
+STATS_TRIGGERS = {
+    "stats_authors_insert": "AFTER INSERT ON Authors BEGIN UPDATE Stats SET value = value + 1 WHERE name = 'authors'; END",
+    "stats_authors_delete": "AFTER DELETE ON Authors BEGIN UPDATE Stats SET value = value - 1 WHERE name = 'authors'; END",
+    "stats_genres_insert": "AFTER INSERT ON Genres BEGIN UPDATE Stats SET value = value + 1 WHERE name = 'genres'; END",
+    "stats_readers_insert": "AFTER INSERT ON Readers BEGIN UPDATE Stats SET value = value + 1 WHERE name = 'readers'; END",
+    "stats_books_insert": '''AFTER INSERT ON Books BEGIN
+        UPDATE Stats SET value = value + 1 WHERE name = 'books';
+        UPDATE Stats SET value = value + NEW.available_copies WHERE name = 'available_copies';
+    END''',
+    "stats_books_copies": '''AFTER UPDATE OF available_copies ON Books BEGIN
+        UPDATE Stats SET value = value + NEW.available_copies - OLD.available_copies WHERE name = 'available_copies';
+    END''',
+    "stats_loans_insert": '''AFTER INSERT ON BookLoans BEGIN
+        UPDATE Stats SET value = value + 1 WHERE name = 'total_loans';
+        UPDATE Stats SET value = value + 1 WHERE name = 'active_loans' AND NEW.return_date IS NULL;
+        INSERT INTO BookLoanCounts (book_id, loans) VALUES (NEW.book_id, 1)
+            ON CONFLICT (book_id) DO UPDATE SET loans = loans + 1;
+        INSERT INTO GenreLoanCounts (genre_id, loans)
+            SELECT genre_id, 1 FROM Books WHERE book_id = NEW.book_id AND genre_id IS NOT NULL
+            ON CONFLICT (genre_id) DO UPDATE SET loans = loans + 1;
+    END''',
+    "stats_loans_return": '''AFTER UPDATE OF return_date ON BookLoans BEGIN
+        UPDATE Stats SET value = value - (OLD.return_date IS NULL) + (NEW.return_date IS NULL) WHERE name = 'active_loans';
+    END''',
+    # Удаление выдачи не стирает историю: уменьшается только число невозвращенных книг
+    "stats_loans_delete": '''AFTER DELETE ON BookLoans BEGIN
+        UPDATE Stats SET value = value - 1 WHERE name = 'active_loans' AND OLD.return_date IS NULL;
+    END''',
+}
+
+
+def migration_create_stats(cursor):
+    # Счетчики для /stats поддерживаются триггерами при каждой записи, чтение не сканирует таблицы
+    stats_exist = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'Stats'").fetchone()
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS BookLoanCounts (
+            book_id INTEGER PRIMARY KEY,
+            loans INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_book_loan_counts ON BookLoanCounts (loans)")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS GenreLoanCounts (
+            genre_id INTEGER PRIMARY KEY,
+            loans INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    for trigger_name, trigger_body in STATS_TRIGGERS.items():
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {trigger_name} {trigger_body}")
+
+    if not stats_exist:
+        # Таблицы счетчиков созданы впервые - заполняем их по существующим данным
+        cursor.execute('''
+            INSERT INTO Stats (name, value)
+            SELECT 'authors', COUNT(*) FROM Authors
+            UNION ALL SELECT 'genres', COUNT(*) FROM Genres
+            UNION ALL SELECT 'readers', COUNT(*) FROM Readers
+            UNION ALL SELECT 'books', COUNT(*) FROM Books
+            UNION ALL SELECT 'available_copies', COALESCE(SUM(available_copies), 0) FROM Books
+            UNION ALL SELECT 'total_loans', COUNT(*) FROM BookLoans
+            UNION ALL SELECT 'active_loans', COUNT(*) FROM BookLoans WHERE return_date IS NULL
+        ''')
+        cursor.execute("INSERT INTO BookLoanCounts (book_id, loans) SELECT book_id, COUNT(*) FROM BookLoans GROUP BY book_id")
+        cursor.execute('''
+            INSERT INTO GenreLoanCounts (genre_id, loans)
+            SELECT b.genre_id, COUNT(*) FROM BookLoans l JOIN Books b ON b.book_id = l.book_id
+            WHERE b.genre_id IS NOT NULL GROUP BY b.genre_id
+        ''')
+
+
+def migration_create_search_index(cursor):
+    # Полнотекстовый поиск: rowid = book_id для книг (название и имя автора)
+    # и -author_id для авторов (имя и биография).
+    # Буква "ё" заменяется на "е", токенизатор unicode61 сам приводит регистр кириллицы.
+    search_index_exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'SearchIndex'"
+    ).fetchone()
+
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS SearchIndex USING fts5(
+            title,
+            author_name,
+            author_bio,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS search_books_insert AFTER INSERT ON Books
+        BEGIN
+            INSERT INTO SearchIndex (rowid, title, author_name, author_bio)
+            SELECT NEW.book_id,
+                   replace(replace(NEW.title, 'ё', 'е'), 'Ё', 'Е'),
+                   replace(replace(a.name, 'ё', 'е'), 'Ё', 'Е'),
+                   NULL
+            FROM (SELECT 1) LEFT JOIN Authors a ON a.author_id = NEW.author_id;
+        END
+    ''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS search_authors_insert AFTER INSERT ON Authors
+        BEGIN
+            INSERT INTO SearchIndex (rowid, title, author_name, author_bio)
+            VALUES (-NEW.author_id, NULL,
+                    replace(replace(NEW.name, 'ё', 'е'), 'Ё', 'Е'),
+                    replace(replace(NEW.bio, 'ё', 'е'), 'Ё', 'Е'));
+            UPDATE SearchIndex
+            SET author_name = replace(replace(NEW.name, 'ё', 'е'), 'Ё', 'Е')
+            WHERE rowid IN (SELECT book_id FROM Books WHERE author_id = NEW.author_id);
+        END
+    ''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS search_authors_delete AFTER DELETE ON Authors
+        BEGIN
+            DELETE FROM SearchIndex WHERE rowid = -OLD.author_id;
+        END
+    ''')
+
+    if not search_index_exists:
+        # Индекс создан впервые - заполняем его существующими книгами и авторами
+        cursor.execute('''
+            INSERT INTO SearchIndex (rowid, title, author_name, author_bio)
+            SELECT b.book_id,
+                   replace(replace(b.title, 'ё', 'е'), 'Ё', 'Е'),
+                   replace(replace(a.name, 'ё', 'е'), 'Ё', 'Е'),
+                   NULL
+            FROM Books b LEFT JOIN Authors a ON a.author_id = b.author_id
+        ''')
+        cursor.execute('''
+            INSERT INTO SearchIndex (rowid, title, author_name, author_bio)
+            SELECT -author_id, NULL,
+                   replace(replace(name, 'ё', 'е'), 'Ё', 'Е'),
+                   replace(replace(bio, 'ё', 'е'), 'Ё', 'Е')
+            FROM Authors
+        ''')
+
+
+# Таблицы, изменения которых видят ETag и кэш ответов, и группы кэша, зависящие от них
+VERSIONED_TABLES = {
+    "Authors": ("authors",),
+    "Genres": ("genres",),
+    "Books": ("book",),
+    "Readers": ("readers",),
+    "BookLoans": (),
+}
+
+
+def migration_create_table_changes(cursor):
+    # Счетчики изменений таблиц в самой базе: по ним воркеры узнают о записях друг друга.
+    # Строка '*' - случайный идентификатор базы, он заменяет boot_id процесса в ETag.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS TableChanges (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            modified REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute(
+        "INSERT OR IGNORE INTO TableChanges (name, version, modified) VALUES ('*', abs(random() % 4294967296), 0)"
+    )
+    for table in VERSIONED_TABLES:
+        cursor.execute(
+            "INSERT OR IGNORE INTO TableChanges (name, version, modified) "
+            "VALUES (?, 0, (julianday('now') - 2440587.5) * 86400.0)", (table,)
+        )
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS changes_{table.lower()}_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    UPDATE TableChanges SET version = version + 1, modified = (julianday('now') - 2440587.5) * 86400.0
+                    WHERE name = '{table}';
+                END
+            ''')
+
+
+def migration_create_loan_history_indexes(cursor):
+    # История выдач читателя и книги: покрывающие индексы содержат все столбцы ответа,
+    # поэтому страница читается диапазоном одного индекса без обращения к таблице.
+    # Индекс по book_id начинается с того же столбца, что idx_loans_book, и заменяет его.
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_loans_reader_history "
+        "ON BookLoans (reader_id, loan_id, book_id, loan_date, due_date, return_date)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_loans_book_history "
+        "ON BookLoans (book_id, loan_id, reader_id, loan_date, due_date, return_date)"
+    )
+    cursor.execute("DROP INDEX IF EXISTS idx_loans_book")
+
+
+def migration_create_loans_archive(cursor):
+    # Закрытые выдачи переносятся сюда, чтобы BookLoans оставался размером с текущий оборот.
+    # Статистика не меняется: триггеры stats_loans_delete учитывают только невозвращенные выдачи.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS BookLoansArchive (
+            loan_id INTEGER PRIMARY KEY,
+            book_id INTEGER,
+            reader_id INTEGER,
+            loan_date DATE NOT NULL,
+            due_date DATE NOT NULL,
+            return_date DATE
+        )
+    ''')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_archive_reader_history "
+        "ON BookLoansArchive (reader_id, loan_id, book_id, loan_date, due_date, return_date)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_archive_book_history "
+        "ON BookLoansArchive (book_id, loan_id, reader_id, loan_date, due_date, return_date)"
+    )
+
+
+def migration_create_events(cursor):
+    # Журнал событий /events: воркер записывает сюда свои события, а остальные воркеры
+    # читают его и раздают своим подписчикам (см. EventHub.relay).
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Events (
+            event_id INTEGER PRIMARY KEY,
+            pid INTEGER NOT NULL,
+            created REAL NOT NULL,
+            kind TEXT NOT NULL,
+            data TEXT NOT NULL
+        )
+    ''')
+
+
+# Порядок менять нельзя: номер миграции - её позиция в списке, начиная с 1
+MIGRATIONS = [
+    migration_create_tables,
+    migration_normalize_loan_dates,
+    migration_create_search_index,
+    migration_create_stats,
+    migration_create_table_changes,
+    migration_create_loan_history_indexes,
+    migration_create_loans_archive,
+    migration_create_events,
+]
+
+
+def migrate(path=None):
+    """Применить к базе миграции, которых в ней еще нет; вернуть итоговую версию схемы
+
+    Каждая миграция выполняется в своей транзакции BEGIN IMMEDIATE вместе с записью
+    user_version, поэтому несколько процессов, стартующих одновременно, не применят её дважды.
+    """
+    conn = sqlite3.connect(path or DB_PATH, timeout=POOL_TIMEOUT)
+    try:
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        # Режим журнала хранится в файле: включаем его до того, как откроются соединения mode=ro
+        conn.execute(f"PRAGMA journal_mode = {PRAGMAS['journal_mode']}")
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            def apply(cursor):
+                if cursor.execute("PRAGMA user_version").fetchone()[0] < version:
+                    migration(cursor)
+                    cursor.execute(f"PRAGMA user_version = {version}")
+            if conn.execute("PRAGMA user_version").fetchone()[0] < version:
+                write_transaction(conn, apply)
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+
+pool = None
+export_pool = None
+db = None
+data_version = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global pool, export_pool, db, data_version
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    migrate(DB_PATH)
+    # У потока записи свое соединение: ни чтения, ни выгрузки не могут занять его место в пуле
+    write_pool = ConnectionPool(DB_PATH, size=1)
+    pool = ConnectionPool(DB_PATH, size=READ_WORKERS, read_only=READ_ONLY_READS)
+    export_pool = ConnectionPool(DB_PATH, size=EXPORT_CONNECTIONS, read_only=READ_ONLY_READS)
+    write_lock = WriteLock(DB_PATH + "-lock") if MULTI_WORKER else None
+    data_version = DataVersion(DB_PATH)
+    db = Database(write_pool, read_pool=pool, write_lock=write_lock, after_write=hub.log_outgoing if MULTI_WORKER else None)
+    archiver = asyncio.create_task(archive_periodically(db, ARCHIVE_INTERVAL)) if ARCHIVE_INTERVAL > 0 else None
+    pinger = asyncio.create_task(hub.keepalive())
+    # Воркеров несколько: события идут через журнал Events, иначе подписчик видел бы только свой процесс
+    hub.relaying = MULTI_WORKER
+    relay = asyncio.create_task(hub.relay(db)) if MULTI_WORKER else None
+    # Копирование, запущенное в любом воркере, ограничивается по задержкам всех воркеров
+    latency = asyncio.create_task(share_latency(DB_PATH)) if MULTI_WORKER else None
+    yield
+    pinger.cancel()
+    for task in (relay, latency):
+        if task is not None:
+            task.cancel()
+    if archiver is not None:
+        archiver.cancel()
+    db.close()
+    export_pool.close()
+    data_version.close()
+
+
+class DataVersion:
+    """Признак записи в базу со времени последней синхронизации счетчиков (PRAGMA data_version)
+
+    У процесса одно долгоживущее соединение только для этой проверки: data_version меняется, когда
+    транзакцию фиксирует любое другое соединение, в том числе поток записи этого же процесса.
+    Проверка читает только заголовок WAL в общей памяти, поэтому выполняется прямо в цикле событий.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.synced = None
+
+    def current(self):
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def sync_table_changes(conn):
+    """Подтянуть счетчики изменений таблиц из базы и сбросить кэш таблиц, измененных другими процессами"""
+    rows = conn.execute("SELECT name, version, modified FROM TableChanges /* full scan */").fetchall()
+    for table in versions.sync(rows):
+        for group in VERSIONED_TABLES.get(table, ()):
+            cache.invalidate(group)
+
+
+async def get_database():
+    """Зависимость FastAPI: исполнитель запросов к базе
+
+    Кэш ответов и ETag сверяются со счетчиками изменений в базе перед каждым запросом: в базу
+    пишут и соседние воркеры, и команды import и archive, о записях которых процесс иначе не узнал бы.
+    Счетчики перечитываются, только если data_version показывает, что базу с тех пор меняли.
+    """
+    version = data_version.current()
+    if version != data_version.synced:
+        await db.read(sync_table_changes)
+        data_version.synced = version
+    return db
+
+
+def is_busy_error(error):
+    message = str(error)
+    return "locked" in message or "busy" in message
+
+
+log = logging.getLogger("library")
+
+
+def report_db_error(operation, error):
+    """Учесть ошибку базы, которую обработчик превращает в ответ с error: счетчик в /metrics и запись в журнал"""
+    metrics.inc("library_db_errors_total", (("operation", operation),))
+    log.error("Ошибка базы в %s: %s", operation, error, exc_info=error)
+
+
+def write_transaction(conn, fn, retries=BUSY_RETRIES):
+    """Выполнить fn(cursor) в транзакции BEGIN IMMEDIATE и зафиксировать её
+
+    Блокировка записи берется в начале транзакции, поэтому между проверкой и изменением строки
+    никто другой писать не может. Если блокировку не удалось получить за busy_timeout,
+    транзакция повторяется до retries раз с растущей паузой.
+    """
+    for attempt in range(retries + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            result = fn(conn.cursor())
+            conn.commit()
+            return result
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.rollback()
+            if not is_busy_error(e) or attempt == retries:
+                raise
+            time.sleep(0.01 * 2 ** attempt)
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+
+def normalize_date(value):
+    """Привести дату к виду ГГГГ-ММ-ДД (принимаются также ДД.ММ.ГГГГ и дата со временем); None, если не разобрать"""
+    value = str(value).strip()
+    for parse in (lambda v: date.fromisoformat(v[:10]), lambda v: datetime.strptime(v, "%d.%m.%Y").date()):
+        try:
+            return parse(value).isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def paginate(headers, rows, limit):
+    """Обрезать страницу до limit строк и передать курсор следующей страницы в заголовке X-Next-After-Id"""
+    if len(rows) > limit:
+        rows = rows[:limit]
+        headers["X-Next-After-Id"] = str(rows[-1][0])
+    return rows
+
+
+class ResponseCache:
+    """LRU-кэш готовых JSON-ответов со сроком жизни записей
+
+    Ключ записи - кортеж, первый элемент которого - группа данных ("authors", "genres", "book").
+    Запись, прочитанная до изменения группы, не сохраняется: invalidate увеличивает версию группы.
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, group):
+        return self._versions.get(group, 0)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, version):
+        with self._lock:
+            if self._versions.get(key[0], 0) != version:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, group, *key):
+        """Сбросить все записи группы или одну запись (group, *key)"""
+        with self._lock:
+            self._versions[group] = self._versions.get(group, 0) + 1
+            if key:
+                self._entries.pop((group, *key), None)
+            else:
+                for cached in [k for k in self._entries if k[0] == group]:
+                    del self._entries[cached]
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+cache = ResponseCache()
+
+
+class TableVersions:
+    """Счетчики изменений таблиц для ETag и Last-Modified списков
+
+    Счетчики берутся из таблицы TableChanges (её ведут триггеры) через sync перед каждым запросом,
+    после первой синхронизации bump ничего не делает. bump нужен только до неё, например в замерах,
+    где функции обработчиков вызываются напрямую.
+    """
+
+    def __init__(self):
+        self.boot_id = uuid.uuid4().hex[:8]
+        self.started = time.time()
+        self.shared = False
+        self._versions = {}
+        self._modified = {}
+        self._lock = threading.Lock()
+
+    def bump(self, *tables):
+        if self.shared:
+            return
+        with self._lock:
+            now = time.time()
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+                self._modified[table] = now
+
+    def etag(self, tables, request):
+        # Разные страницы и фильтры одной таблицы получают разные ETag
+        params = zlib.crc32(str(request.query_params).encode("utf-8"))
+        table_versions = "-".join(f"{table}.{self._versions.get(table, 0)}" for table in tables)
+        return f'"{self.boot_id}-{table_versions}-{params:08x}"'
+
+    def last_modified(self, tables):
+        return max(self._modified.get(table, self.started) for table in tables)
+
+    def sync(self, rows):
+        """Принять строки (таблица, версия, время изменения) из TableChanges; вернуть изменившиеся таблицы"""
+        changed = []
+        with self._lock:
+            self.shared = True
+            for table, version, modified in rows:
+                if table == "*":
+                    self.boot_id = f"{version:08x}"
+                    continue
+                if self._versions.get(table) != version:
+                    changed.append(table)
+                self._versions[table] = version
+                self._modified[table] = modified
+        return changed
+
+
+versions = TableVersions()
+
+
+class Subscription:
+    """Подписчик потока событий: фильтры и очередь готовых к отправке сообщений"""
+
+    __slots__ = ("book_id", "reader_id", "since", "messages", "ready", "closed")
+
+    def __init__(self, book_id=None, reader_id=None):
+        self.book_id = book_id
+        self.reader_id = reader_id
+        self.since = time.time()
+        self.messages = deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+
+    def matches(self, event):
+        return (self.book_id is None or self.book_id == event.get("book_id")) and (
+            self.reader_id is None or self.reader_id == event.get("reader_id")
+        )
+
+    def push(self, message, limit):
+        if self.closed:
+            return
+        if len(self.messages) >= limit:
+            # Клиент не успевает читать: очередь сбрасывается, клиент получает reset и перечитывает данные
+            self.reset()
+            return
+        self.messages.append(message)
+        self.ready.set()
+
+    def reset(self):
+        """Закрыть поток событием reset: часть событий потеряна, данные нужно перечитать"""
+        if self.closed:
+            return
+        self.messages.clear()
+        self.messages.append(b"event: reset\ndata: {}\n\n")
+        self.closed = True
+        self.ready.set()
+
+
+class EventHub:
+    """Рассылка событий об изменениях подписчикам /events
+
+    publish можно вызывать из любого потока: событие сериализуется один раз и раздается
+    в цикле событий. Подписчики с фильтром хранятся в словарях по book_id и reader_id,
+    поэтому событие просматривает только тех, кому оно может подойти. Простаивающий
+    подписчик - это очередь и ожидающая корутина; пинги рассылает одна общая задача.
+    Когда воркеров несколько, все события раздаются из таблицы Events (см. relay).
+    """
+
+    def __init__(self, queue_size=EVENT_QUEUE_SIZE, log_size=EVENT_LOG_SIZE):
+        self.queue_size = queue_size
+        self.log_size = log_size
+        self.loop = None
+        self.published = 0
+        self.relayed = 0
+        self.count = 0
+        self.relaying = False
+        self._outgoing = deque()
+        self._all = set()
+        self._by_book = {}
+        self._by_reader = {}
+
+    def subscribe(self, book_id=None, reader_id=None):
+        self.loop = asyncio.get_running_loop()
+        subscription = Subscription(book_id, reader_id)
+        if book_id is not None:
+            self._by_book.setdefault(book_id, set()).add(subscription)
+        elif reader_id is not None:
+            self._by_reader.setdefault(reader_id, set()).add(subscription)
+        else:
+            self._all.add(subscription)
+        self.count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription.book_id is not None:
+            index, key = self._by_book, subscription.book_id
+        elif subscription.reader_id is not None:
+            index, key = self._by_reader, subscription.reader_id
+        else:
+            index, key = None, None
+        subscribers = self._all if index is None else index.get(key, set())
+        if subscription not in subscribers:
+            return
+        subscribers.discard(subscription)
+        self.count -= 1
+        if index is not None and not subscribers:
+            del index[key]
+
+    def publish(self, kind, **data):
+        """Разослать событие kind с полями data; без подписчиков ничего не делает"""
+        if self.relaying:
+            # Событие сначала попадает в журнал (log_outgoing), оттуда его раздают все воркеры
+            self._outgoing.append((kind, data))
+            return
+        if self.loop is None or not self.count:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._dispatch, kind, data)
+        except RuntimeError:
+            # Цикл событий уже остановлен
+            pass
+
+    def _dispatch(self, kind, data, created=None):
+        self.published += 1
+        message = f"id: {self.published}\nevent: {kind}\ndata: ".encode("utf-8") + json_bytes(data) + b"\n\n"
+        targets = list(self._all)
+        targets.extend(self._by_book.get(data.get("book_id"), ()))
+        targets.extend(self._by_reader.get(data.get("reader_id"), ()))
+        for subscription in targets:
+            # Событие из журнала, записанное до подписки, подписчику не нужно
+            if subscription.matches(data) and (created is None or created >= subscription.since):
+                subscription.push(message, self.queue_size)
+
+    async def keepalive(self, interval=EVENT_KEEPALIVE):
+        """Периодически отправлять всем подписчикам комментарий, чтобы прокси не закрывали соединения"""
+        while True:
+            await asyncio.sleep(interval)
+            for subscription in self.subscribers():
+                subscription.push(b": ping\n\n", self.queue_size)
+
+    def subscribers(self):
+        yield from self._all
+        for index in (self._by_book, self._by_reader):
+            for subscribers in index.values():
+                yield from subscribers
+
+    def log_outgoing(self, conn):
+        """Записать накопленные события в журнал Events (в потоке записи, см. Database.after_write)
+
+        Поток записи вызывает это сразу после каждой записи, еще под блокировкой записи и до ответа
+        клиенту, поэтому порядок событий в журнале совпадает с порядком изменений во всех воркерах.
+        Если записать не удалось, события остаются в очереди до следующей попытки.
+        """
+        events = []
+        while self._outgoing:
+            events.append(self._outgoing.popleft())
+        if not events:
+            return
+        try:
+            log_events(conn, os.getpid(), events, self.log_size)
+        except sqlite3.Error:
+            self._outgoing.extendleft(reversed(events))
+
+    async def flush(self, db):
+        """Записать в журнал события, опубликованные вне потока записи (после transaction)"""
+        if self._outgoing:
+            await db.write(self.log_outgoing)
+
+    async def relay(self, db, interval=EVENT_POLL_INTERVAL):
+        """Раздавать местным подписчикам события всех воркеров из журнала Events
+
+        Раз в interval читаются события, появившиеся с прошлого опроса, в порядке event_id,
+        в том числе собственные: так подписчики любого воркера видят события в одном порядке.
+        Если воркер отстал и часть событий уже удалена из журнала, подписчики получают reset.
+        """
+        seen = None
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush(db)
+                if seen is None or not self.count:
+                    # Раздавать события некому: достаточно запомнить, докуда журнал прочитан
+                    (seen,), = await db.fetch_all("SELECT coalesce(max(event_id), 0) FROM Events")
+                    continue
+                events = await db.fetch_all(
+                    "SELECT event_id, created, kind, data FROM Events WHERE event_id > ? ORDER BY event_id", (seen,)
+                )
+            except sqlite3.Error:
+                continue
+            if events and events[0][0] != seen + 1:
+                for subscription in list(self.subscribers()):
+                    subscription.reset()
+            for event_id, created, kind, data in events:
+                seen = event_id
+                self.relayed += 1
+                self._dispatch(kind, json.loads(data), created)
+
+    def stats(self):
+        return {"subscribers": self.count, "published": self.published, "relayed": self.relayed}
+
+
+hub = EventHub()
+
+
+def log_events(conn, pid, events, log_size=EVENT_LOG_SIZE):
+    """Записать события процесса pid в журнал Events и оставить в нем только последние log_size"""
+    created = time.time()
+
+    def append(cursor):
+        cursor.executemany(
+            "INSERT INTO Events (pid, created, kind, data) VALUES (?, ?, ?, ?)",
+            [(pid, created, kind, json.dumps(data, ensure_ascii=False)) for kind, data in events]
+        )
+        cursor.execute("DELETE FROM Events WHERE event_id <= (SELECT max(event_id) FROM Events) - ?", (log_size,))
+
+    write_transaction(conn, append)
+
+
+def conditional_get(request, response, *tables):
+    """Проставить ETag и Last-Modified; вернуть ответ 304, если у клиента актуальная версия таблиц
+
+    Вызывается до запроса к базе, чтобы при совпадении версии не выполнять ни запрос, ни сериализацию.
+    """
+    etag = versions.etag(tables, request)
+    modified = versions.last_modified(tables)
+    headers = {"ETag": etag, "Last-Modified": formatdate(modified, usegmt=True)}
 
-# Создаем базу данных и таблицы
-conn = sqlite3.connect("simple_library.db")
-cursor = conn.cursor()
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        fresh = if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]
+    else:
+        fresh = False
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                fresh = int(modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                fresh = False
 
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS Authors (
-        author_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        bio TEXT
-    )
-''')
+    if fresh:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+
+def json_bytes(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def rows_response(response, columns, rows):
+    """Строки курсора сразу в JSON-массив объектов, минуя jsonable_encoder FastAPI
+
+    Заголовки, уже выставленные в response (ETag, X-Next-After-Id), переносятся в ответ.
+    """
+    body = json_bytes([dict(zip(columns, row)) for row in rows])
+    return Response(content=body, media_type="application/json", headers=dict(response.headers))
+
+
+async def cached_json(key, load):
+    """Отдать готовый ответ из кэша или построить его через load() -> (данные, заголовки) и сохранить"""
+    entry = cache.get(key)
+    if entry is None:
+        version = cache.version(key[0])
+        data, headers = await load()
+        entry = (json_bytes(data), headers)
+        cache.set(key, entry, version)
+    body, headers = entry
+    return Response(content=body, media_type="application/json", headers=headers)
 
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS Genres (
-        genre_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        description TEXT
+
+def export_rows(query, columns, export_format):
+    """Генератор выгрузки: читает курсор порциями через fetchmany и отдает их по мере готовности"""
+    # Соединение берется из пула здесь: генератор работает в потоках Starlette, пока ответ передается клиенту
+    conn = export_pool.acquire()
+    try:
+        cursor = conn.execute(query)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == "csv":
+            writer.writerow(columns)
+
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            if export_format == "csv":
+                writer.writerows(rows)
+            else:
+                for row in rows:
+                    buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                    buffer.write("\n")
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    finally:
+        export_pool.release(conn)
+
+
+def export_response(query, columns, export_format):
+    if export_pool.exhausted():
+        return {"error": "Слишком много одновременных выгрузок, повторите попытку"}
+    return StreamingResponse(
+        export_rows(query, columns, export_format),
+        media_type=EXPORT_MEDIA_TYPES[export_format]
     )
-''')
-
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS Books (
-        book_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        title TEXT NOT NULL,
-        author_id INTEGER,
-        genre_id INTEGER,
-        isbn TEXT UNIQUE,
-        publication_year INTEGER,
-        available_copies INTEGER DEFAULT 1
+
+
+def book_filters(after_id, author_id, genre_id, year_from, year_to, available_only):
+    """Условия WHERE (для таблицы Books с псевдонимом b) и параметры для списков книг"""
+    conditions = ["b.book_id > ?"]
+    params = [after_id]
+    if author_id is not None:
+        conditions.append("b.author_id = ?")
+        params.append(author_id)
+    if genre_id is not None:
+        conditions.append("b.genre_id = ?")
+        params.append(genre_id)
+    if year_from is not None:
+        conditions.append("b.publication_year >= ?")
+        params.append(year_from)
+    if year_to is not None:
+        conditions.append("b.publication_year <= ?")
+        params.append(year_to)
+    if available_only:
+        conditions.append("b.available_copies > 0")
+    return " AND ".join(conditions), params
+
+
+def loans_page_query(where, params, limit, include_archive=False, indexes=(None, None)):
+    """Запрос страницы выдач по loan_id: из BookLoans или, если include_archive, вместе с архивом
+
+    Каждая часть объединения сама ограничена limit + 1 строками, поэтому общий порядок
+    собирается из двух коротких списков. indexes - индексы для INDEXED BY (BookLoans, архив).
+    """
+    def part(table, index):
+        indexed_by = f" INDEXED BY {index}" if index else ""
+        return (
+            f"SELECT loan_id, book_id, reader_id, loan_date, due_date, return_date FROM {table}{indexed_by} "
+            f"WHERE {where} ORDER BY loan_id LIMIT ?"
+        )
+
+    if not include_archive:
+        return part("BookLoans", indexes[0]), params + [limit + 1]
+    sql = (
+        f"SELECT * FROM ({part('BookLoans', indexes[0])}) "
+        f"UNION ALL SELECT * FROM ({part('BookLoansArchive', indexes[1])}) "
+        "ORDER BY loan_id LIMIT ?"
     )
-''')
-
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS Readers (
-        reader_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        first_name TEXT NOT NULL,
-        last_name TEXT NOT NULL,
-        email TEXT UNIQUE NOT NULL,
-        phone TEXT
+    return sql, params + [limit + 1] + params + [limit + 1] + [limit + 1]
+
+
+def archive_batch(cursor, cutoff, after_id, batch_size=ARCHIVE_BATCH_SIZE):
+    """Перенести в архив выдачи, возвращенные не позже cutoff, среди batch_size выдач после after_id
+
+    Транзакция просматривает не больше batch_size строк, поэтому держит блокировку записи недолго.
+    Возвращает (перенесено, последний просмотренный loan_id или None, если выдачи закончились).
+    """
+    window = cursor.execute(
+        "SELECT loan_id, return_date FROM BookLoans WHERE loan_id > ? ORDER BY loan_id LIMIT ?", (after_id, batch_size)
+    ).fetchall()
+    if not window:
+        return 0, None
+    ids = json.dumps([loan_id for loan_id, return_date in window if return_date is not None and return_date <= cutoff])
+    cursor.execute(
+        "INSERT INTO BookLoansArchive (loan_id, book_id, reader_id, loan_date, due_date, return_date) "
+        "SELECT loan_id, book_id, reader_id, loan_date, due_date, return_date FROM BookLoans "
+        "WHERE loan_id IN (SELECT value FROM json_each(?))", (ids,)
     )
-''')
-
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS BookLoans (
-        loan_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        book_id INTEGER,
-        reader_id INTEGER,
-        loan_date DATE NOT NULL,
-        due_date DATE NOT NULL,
-        return_date DATE
+    cursor.execute("DELETE FROM BookLoans WHERE loan_id IN (SELECT value FROM json_each(?))", (ids,))
+    return cursor.rowcount, window[-1][0]
+
+
+async def archive_loans(db, older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """Перенести в архив все выдачи, возвращенные больше older_than_days дней назад
+
+    Каждая порция - отдельная транзакция в очереди потока записи, между ними проходят остальные записи.
+    """
+    cutoff = str(date.today() - timedelta(days=older_than_days))
+    archived = 0
+    after_id = 0
+    while after_id is not None:
+        moved, after_id = await db.transaction(archive_batch, cutoff, after_id, batch_size)
+        archived += moved
+    if archived:
+        versions.bump("BookLoans")
+    return archived
+
+
+async def archive_periodically(db, interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await archive_loans(db)
+        except sqlite3.Error:
+            pass  # повторим при следующем запуске
+
+
+class Backup:
+    """Онлайн-копия базы через backup API SQLite, без остановки сервера
+
+    Копия согласована на момент начала: исходное соединение держит транзакцию чтения, поэтому
+    записи других соединений не перезапускают копирование с начала (в режиме WAL писатели не
+    ждут, но контрольная точка не продвинется дальше снимка, пока копирование не закончится).
+    Страницы переносятся порциями по pages, между порциями поток спит, чтобы копирование
+    занимало не больше duty времени. Если p99 маршрутов BACKUP_WATCHED_ROUTES выходит за budget,
+    доля урезается вдвое. При нескольких воркерах p99 считается по всем: каждый воркер на время
+    копирования выкладывает свои гистограммы рядом с базой (см. share_latency). Цель с суффиксом
+    .gz сжимается gzip.
+    Файл появляется под именем target только целиком, до этого копия пишется в target.part.
+
+    Копирование одной базы идет только одно на все процессы: его держит блокировка source-backup-lock,
+    а ход раз в CHECK_INTERVAL записывается в source-backup.json, откуда его читает любой воркер
+    (см. read_backup_status).
+    """
+
+    CHECK_INTERVAL = 0.5
+
+    def __init__(self, source, target, pages=BACKUP_PAGES, duty=BACKUP_DUTY, budget=BACKUP_P99_BUDGET):
+        self.source = source
+        self.lock = WriteLock(source + "-backup-lock")
+        self.status_path = source + "-backup.json"
+        self.target = target
+        self.compress = target.endswith(".gz")
+        self.pages = pages
+        self.max_duty = self.duty = min(max(duty, 0.01), 1.0)
+        self.budget = budget
+        self.running = False
+        self.error = None
+        self.pages_total = 0
+        self.pages_done = 0
+        self.throttled = 0
+        self.duration = 0.0
+        self._started = None
+        self._step_started = None
+        self._window = None
+        self._published = 0.0
+
+    def acquire(self):
+        """Взять блокировку копирования и объявить его начатым; False, если копирование уже идет"""
+        if not self.lock.acquire(blocking=False):
+            self.lock.close()
+            return False
+        self.running = True
+        self._started = time.perf_counter()
+        self._publish()
+        return True
+
+    def start(self):
+        """Запустить копирование в фоновом потоке; False, если копирование уже идет"""
+        if not self.acquire():
+            return False
+        threading.Thread(target=self.run, name="library-backup", daemon=True).start()
+        return True
+
+    def run(self):
+        """Скопировать базу; блокировку берет сам, если она не взята через start()"""
+        if not self.running and not self.acquire():
+            self.error = "Резервное копирование уже идет"
+            return False
+        part = self.target + ".part"
+        try:
+            # Файл создается заранее: второе копирование в ту же цель сразу получит ошибку
+            open(part, "x").close()
+            try:
+                self._copy(part)
+                if self.compress:
+                    self._gzip(part, part + ".gz")
+                    os.replace(part + ".gz", self.target)
+                    os.remove(part)
+                else:
+                    os.replace(part, self.target)
+            except BaseException:
+                for leftover in (part, part + ".gz", part + "-journal"):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+                raise
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.duration = time.perf_counter() - self._started
+            self.running = False
+            # Итог записывается до снятия блокировки, чтобы его не приняли за прерванное копирование
+            self._publish()
+            self.lock.close()
+        return self.error is None
+
+    def _publish(self):
+        """Записать stats() в общий файл состояния; файл заменяется целиком, читатели не видят его половину"""
+        self._published = time.perf_counter()
+        part = f"{self.status_path}.{os.getpid()}"
+        with open(part, "w", encoding="utf-8") as f:
+            json.dump(self.stats(), f)
+        os.replace(part, self.status_path)
+
+    def _copy(self, path):
+        source = sqlite3.connect(self.source, timeout=POOL_TIMEOUT, isolation_level=None)
+        target = sqlite3.connect(path)
+        try:
+            # Снимок берется первым чтением транзакции и держится до конца копирования
+            source.execute("BEGIN")
+            source.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+            self._window = (time.perf_counter(), self._snapshot())
+            self._step_started = time.perf_counter()
+            source.backup(target, pages=self.pages, progress=self._progress)
+            source.execute("ROLLBACK")
+            # Заголовок копии унаследовал режим WAL; копия должна быть одним самостоятельным файлом
+            target.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            target.close()
+            source.close()
+
+    def _gzip(self, path, compressed):
+        with open(path, "rb") as raw, gzip.open(compressed, "wb", compresslevel=1) as out:
+            while True:
+                start = time.perf_counter()
+                chunk = raw.read(1 << 20)
+                if not chunk:
+                    break
+                out.write(chunk)
+                self._pace(time.perf_counter() - start)
+
+    def _progress(self, status, remaining, total):
+        self.pages_total = total
+        self.pages_done = total - remaining
+        self._pace(time.perf_counter() - self._step_started)
+        self._step_started = time.perf_counter()
+
+    def _pace(self, worked):
+        self._adjust()
+        if time.perf_counter() - self._published >= self.CHECK_INTERVAL:
+            self._publish()
+        if self.duty < 1:
+            time.sleep(worked * (1 - self.duty) / self.duty)
+
+    def _snapshot(self):
+        """Гистограммы наблюдаемых маршрутов по процессам: {pid: [гистограмма или None на маршрут]}"""
+        snapshot = read_shared_latency(self.source, 2 * self.CHECK_INTERVAL) if MULTI_WORKER else {}
+        snapshot[os.getpid()] = watched_latency()
+        return snapshot
+
+    def _adjust(self):
+        """Раз в CHECK_INTERVAL сверить p99 наблюдаемых маршрутов с бюджетом и поправить долю времени"""
+        if self.budget is None or time.perf_counter() - self._window[0] < self.CHECK_INTERVAL:
+            return
+        before, after = self._window[1], self._snapshot()
+        self._window = (time.perf_counter(), after)
+        worst = None
+        for route in range(len(BACKUP_WATCHED_ROUTES)):
+            # Корзины складываются по процессам; процесс без прошлого снимка войдет в следующее окно
+            old_total = new_total = None
+            for pid, histograms in after.items():
+                new = histograms[route]
+                if new is None or pid not in before:
+                    continue
+                old = before[pid][route] or [0] * len(new)
+                old_total = old if old_total is None else [a + b for a, b in zip(old_total, old)]
+                new_total = new if new_total is None else [a + b for a, b in zip(new_total, new)]
+            if new_total is None:
+                continue
+            p99 = metrics.quantile(old_total, new_total, 0.99)
+            if p99 is not None:
+                worst = p99 if worst is None else max(worst, p99)
+        if worst is not None and worst > self.budget:
+            self.duty = max(self.duty / 2, 0.01)
+            self.throttled += 1
+        elif worst is None or worst <= self.budget / 2:
+            self.duty = min(self.duty * 1.25, self.max_duty)
+
+    def stats(self):
+        return {
+            "target": self.target,
+            "running": self.running,
+            "pages_total": self.pages_total,
+            "pages_done": self.pages_done,
+            "duration_seconds": round(time.perf_counter() - self._started if self.running and self._started else self.duration, 3),
+            "duty": round(self.duty, 3),
+            "throttled": self.throttled,
+            "error": self.error,
+        }
+
+
+def watched_latency():
+    """Гистограммы времени ответа маршрутов BACKUP_WATCHED_ROUTES в этом процессе (None, если запросов не было)"""
+    return [
+        metrics.histogram("library_http_request_duration_seconds", (("method", method), ("route", route)))
+        for method, route in BACKUP_WATCHED_ROUTES
+    ]
+
+
+def read_shared_latency(source, max_age):
+    """Гистограммы наблюдаемых маршрутов, выложенные воркерами за последние max_age секунд: {pid: [...]}"""
+    shared = {}
+    for path in glob.glob(glob.escape(source) + "-latency-*.json"):
+        try:
+            with open(path, encoding="utf-8") as f:
+                latency = json.load(f)
+        except (OSError, ValueError):
+            # Файл удаляют или заменяют прямо сейчас
+            continue
+        if time.time() - latency["updated"] <= max_age:
+            shared[latency["pid"]] = latency["histograms"]
+    return shared
+
+
+async def share_latency(source, interval=Backup.CHECK_INTERVAL / 2):
+    """Пока идет копирование базы source, выкладывать гистограммы наблюдаемых маршрутов этого воркера
+
+    Копирование, запущенное в другом воркере, сверяет с бюджетом p99 запросов всех воркеров.
+    Файл source-latency-<pid>.json заменяется целиком и удаляется при остановке воркера.
+    """
+    path = f"{source}-latency-{os.getpid()}.json"
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            status = read_backup_status(source)
+            if status is None or not status["running"]:
+                continue
+            with open(path + ".part", "w", encoding="utf-8") as f:
+                json.dump({"pid": os.getpid(), "updated": time.time(), "histograms": watched_latency()}, f)
+            os.replace(path + ".part", path)
+    finally:
+        for leftover in (path, path + ".part"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def read_backup_status(source):
+    """Ход текущего или итог последнего копирования базы source из общего файла состояния; None, если его не было
+
+    Если файл говорит, что копирование идет, а его блокировка свободна, процесс копирования
+    завершился, не записав итог.
+    """
+    status_path = source + "-backup.json"
+    try:
+        with open(status_path, encoding="utf-8") as f:
+            status = json.load(f)
+    except FileNotFoundError:
+        return None
+    if not status["running"] or fcntl is None:
+        return status
+    lock = WriteLock(source + "-backup-lock")
+    try:
+        if lock.acquire(blocking=False):
+            # Итог мог быть записан между чтением файла и проверкой блокировки
+            with open(status_path, encoding="utf-8") as f:
+                status = json.load(f)
+            if status["running"]:
+                status.update(running=False, error=status["error"] or "Копирование прервано")
+    finally:
+        lock.close()
+    return status
+
+
+def backup_path(compress=False):
+    """Имя новой копии в каталоге BACKUP_DIR по текущему времени"""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    return os.path.join(BACKUP_DIR, f"library-{datetime.now():%Y%m%d-%H%M%S}.db" + (".gz" if compress else ""))
+
+
+async def loan_history(request, response, db, column, key, date_from, date_to, after_id, limit, include_archive=False):
+    """Страница выдач одного читателя или одной книги (column = reader_id или book_id)
+
+    Выдачи идут по loan_id, фильтр по дате выдачи проверяется по тому же покрывающему индексу.
+    Возвращает Response или словарь с ошибкой.
+    """
+    not_modified = conditional_get(request, response, "BookLoans")
+    if not_modified:
+        return not_modified
+
+    indexes = {
+        "reader_id": ("idx_loans_reader_history", "idx_archive_reader_history"),
+        "book_id": ("idx_loans_book_history", "idx_archive_book_history"),
+    }[column]
+    conditions = [f"{column} = ?", "loan_id > ?"]
+    params = [key, after_id]
+    for value, condition in ((date_from, "loan_date >= ?"), (date_to, "loan_date <= ?")):
+        if value is None:
+            continue
+        value = normalize_date(value)
+        if not value:
+            return {"error": "Некорректная дата, ожидается ГГГГ-ММ-ДД"}
+        conditions.append(condition)
+        params.append(value)
+
+    loans = await db.fetch_all(*loans_page_query(" AND ".join(conditions), params, limit, include_archive, indexes))
+    loans = paginate(response.headers, loans, limit)
+
+    if not loans:
+        return {"error": "Выдачи не найдены"}
+
+    return rows_response(response, LOAN_COLUMNS, loans)
+
+
+def search_query(text):
+    """Преобразовать строку пользователя в запрос FTS5: все слова обязательны, каждое - как префикс"""
+    words = re.findall(r"\w+", text.replace("ё", "е").replace("Ё", "Е"))
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def search_rows(conn, query, limit, offset):
+    """Строки поиска по релевантности и признак того, что ранжированы не все совпадения
+
+    Совпадение в названии весит больше, чем в имени автора, а имя - больше, чем биография.
+    Если совпадений не больше SEARCH_CANDIDATES, ранжируются все. У слишком общего запроса
+    (две-три буквы совпадают с сотнями тысяч книг) bm25 считается только для первых
+    SEARCH_CANDIDATES совпадений по rowid, и об этом сообщается клиенту.
+    """
+    matches = conn.execute(
+        "SELECT count(*) FROM (SELECT rowid FROM SearchIndex WHERE SearchIndex MATCH ? LIMIT ?)",
+        (query, SEARCH_CANDIDATES + 1)
+    ).fetchone()[0]
+    truncated = matches > SEARCH_CANDIDATES
+    cutoff = (
+        " AND rowid <= (SELECT max(rowid) FROM (SELECT rowid FROM SearchIndex WHERE SearchIndex MATCH ?1 LIMIT ?4))"
+        if truncated else ""
     )
-''')
+    rows = conn.execute(
+        "SELECT rowid, title, author_name, author_bio, bm25(SearchIndex, 10.0, 5.0, 1.0) AS score "
+        f"FROM SearchIndex WHERE SearchIndex MATCH ?1{cutoff} ORDER BY score LIMIT ?2 OFFSET ?3",
+        (query, limit, offset, SEARCH_CANDIDATES) if truncated else (query, limit, offset)
+    ).fetchall()
+    return rows, truncated
+
+
+def parse_records(text):
+    """Разобрать тело запроса: JSON-массив или NDJSON (по объекту в строке)"""
+    text = text.strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def bulk_insert(conn, kind, records, chunk_size=BULK_CHUNK_SIZE):
+    """Массовая вставка записей через executemany, каждая порция - отдельная транзакция"""
+    table, columns, required, defaults = BULK_TABLES[kind]
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    inserted = 0
+    errors = []
+
+    for start in range(0, len(records), chunk_size):
+        chunk = []
+        for index in range(start, min(start + chunk_size, len(records))):
+            record = records[index]
+            if not isinstance(record, dict) or any(record.get(c) in (None, "") for c in required):
+                errors.append({"row": index, "error": "Не заполнены обязательные поля"})
+                continue
+            # Явный null в необязательном поле значит то же, что отсутствующее поле
+            values = tuple(defaults.get(c) if record.get(c) is None else record[c] for c in columns)
+            # Объект или массив в поле SQLite не примет - ошибка относится к этой строке, а не ко всей загрузке
+            invalid = [c for c, value in zip(columns, values) if not isinstance(value, (str, int, float, type(None)))]
+            if invalid:
+                errors.append({"row": index, "error": f"Некорректное значение поля: {', '.join(invalid)}"})
+                continue
+            chunk.append((index, values))
+
+        try:
+            conn.executemany(sql, [values for _, values in chunk])
+            conn.commit()
+            inserted += len(chunk)
+        except sqlite3.IntegrityError:
+            # В порции есть дубликаты (isbn, email) - повторяем её построчно, чтобы указать строки с ошибкой
+            conn.rollback()
+            for index, values in chunk:
+                try:
+                    conn.execute(sql, values)
+                    inserted += 1
+                except sqlite3.IntegrityError as e:
+                    if "UNIQUE constraint failed" in str(e):
+                        errors.append({"row": index, "error": f"Запись уже существует: {e}"})
+                    else:
+                        errors.append({"row": index, "error": f"Некорректная запись: {e}"})
+            conn.commit()
+
+    errors.sort(key=lambda e: e["row"])
+    return {"inserted": inserted, "errors": errors}
+
+
+def created_books(conn, records, errors):
+    """Книги, добавленные массовой загрузкой (строки без ошибки, найденные по isbn), для событий book_created"""
+    failed = {error["row"] for error in errors}
+    isbns = [str(record["isbn"]) for index, record in enumerate(records) if index not in failed]
+    return conn.execute(
+        "SELECT book_id, title, author_id, genre_id, available_copies FROM Books "
+        "WHERE isbn IN (SELECT value FROM json_each(?)) ORDER BY book_id",
+        (json.dumps(isbns),)
+    ).fetchall()
+
+
+async def bulk_import(kind, request, db):
+    try:
+        records = parse_records((await request.body()).decode("utf-8"))
+    except ValueError:
+        return {"error": "Некорректный JSON"}
+    if not isinstance(records, list):
+        return {"error": "Ожидается массив записей"}
+
+    def insert(conn):
+        result = bulk_insert(conn, kind, records)
+        # Новые книги перечитываются, только если событие есть кому получить
+        if kind == "books" and (hub.count or hub.relaying):
+            for book_id, title, author_id, genre_id, available_copies in created_books(conn, records, result["errors"]):
+                hub.publish(
+                    "book_created", book_id=book_id, title=title, author_id=author_id, genre_id=genre_id,
+                    available_copies=available_copies,
+                )
+        return result
+
+    result = await db.write(insert)
+    cache.invalidate(BULK_CACHE_GROUPS[kind])
+    versions.bump(BULK_TABLES[kind][0])
+    return result
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+
+# Каталог проверяется при первом запросе, а не при импорте модуля
+app.mount("/static", StaticFiles(directory="static", check_dir=False), name="static")
+
+@app.get("/")
+def read_root():
+    return FileResponse("static/index.html")
+
+@app.get("/health")
+async def health_check(db: Database = Depends(get_database)):
+    """Проверка доступности базы данных"""
+    (schema_version,), = await db.fetch_all("PRAGMA user_version")
+    return {"status": "ok", "schema_version": schema_version, **db.stats(), "export_pool": export_pool.stats(), "cache": cache.stats(), "events": hub.stats(), "sql": audit.stats()}
+
+@app.get("/metrics")
+def get_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    gauges = []
+    if db is not None:
+        for name, pool_stats in dict(db.stats(), export_pool=export_pool.stats()).items():
+            gauges.append(("library_pool_connections", (("pool", name), ("state", "open")), pool_stats["open"]))
+            gauges.append(("library_pool_connections", (("pool", name), ("state", "idle")), pool_stats["idle"]))
+            gauges.append(("library_pool_connections", (("pool", name), ("state", "max")), pool_stats["size"]))
+    backup_stats = read_backup_status(DB_PATH)
+    if backup_stats is not None:
+        gauges.append(("library_backup_running", (), int(backup_stats["running"])))
+        gauges.append(("library_backup_pages", (("state", "done"),), backup_stats["pages_done"]))
+        gauges.append(("library_backup_pages", (("state", "total"),), backup_stats["pages_total"]))
+        gauges.append(("library_backup_duration_seconds", (), backup_stats["duration_seconds"]))
+    cache_stats = cache.stats()
+    gauges.append(("library_cache_entries", (), cache_stats["entries"]))
+    gauges.append(("library_cache_requests_total", (("result", "hit"),), cache_stats["hits"]))
+    gauges.append(("library_cache_requests_total", (("result", "miss"),), cache_stats["misses"]))
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+@app.post("/admin/backup")
+async def start_backup(compress: bool = False):
+    """Запустить онлайн-копию базы в каталог BACKUP_DIR (сжатую gzip при compress); ход - GET /admin/backup
+
+    Скорость копирования подстраивается под p99 наблюдаемых маршрутов всех воркеров, а не только этого.
+    """
+    backup = Backup(DB_PATH, backup_path(compress))
+    if not backup.start():
+        return {"error": "Резервное копирование уже идет"}
+    return {"target": backup.target, "message": "Резервное копирование запущено"}
+
+@app.get("/admin/backup")
+def get_backup():
+    """Ход текущего или итог последнего резервного копирования (в любом воркере или команде backup)"""
+    status = read_backup_status(DB_PATH)
+    if status is None:
+        return {"error": "Резервное копирование не запускалось"}
+    return status
+
+@app.get("/debug/query-plans")
+def get_query_plans():
+    """Запросы, план которых просматривает таблицу целиком (заполняется при LIBRARY_PLAN_CHECK=1)"""
+    return {"plan_check": audit.check, "full_scans": [{"statement": sql, "plan": plan} for sql, plan in audit.scans.items()]}
+
+@app.get("/events")
+async def get_events(book_id: Optional[int] = None, reader_id: Optional[int] = None):
+    """Поток изменений в формате server-sent events, с фильтром по книге и/или читателю
 
-conn.commit()
-conn.close()
+    События: book_created, loan_created, book_returned, author_deleted. В данных - идентификаторы
+    и новое значение available_copies, так что перечитывать списки клиенту не нужно.
+    Событие reset значит, что клиент отстал: очередь сброшена, данные нужно перечитать.
+    При нескольких воркерах события раздаются из общего журнала Events с задержкой до EVENT_POLL_INTERVAL.
+    """
+    async def stream():
+        # Подписка оформляется при первом шаге генератора: до этого клиент мог уже отключиться
+        subscription = hub.subscribe(book_id, reader_id)
+        try:
+            yield b"retry: 3000\n\n"
+            while subscription.messages or not subscription.closed:
+                await subscription.ready.wait()
+                subscription.ready.clear()
+                chunk = b"".join(subscription.messages)
+                subscription.messages.clear()
+                yield chunk
+        finally:
+            hub.unsubscribe(subscription)
+
+    return StreamingResponse(
+        stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 # Авторы
 @app.post("/authors/")
-def create_author(name: str, bio: str = ""):
+async def create_author(name: str, bio: str = "", db: Database = Depends(get_database)):
     """Создание автора"""
-    conn = sqlite3.connect("simple_library.db")
-    cursor = conn.cursor()
-    try:
+    def insert(cursor):
         cursor.execute("INSERT INTO Authors (name, bio) VALUES (?, ?)", (name, bio))
-        conn.commit()
-        author_id = cursor.lastrowid
-        return {"author_id": author_id, "message": "Автор создан"}
-    except:
+        return cursor.lastrowid
+
+    try:
+        author_id = await db.transaction(insert)
+    except sqlite3.IntegrityError:
         return {"error": "Такой автор уже существует"}
-    finally:
-        conn.close()
+    except sqlite3.OperationalError as e:
+        if not is_busy_error(e):
+            raise
+        return {"error": "База данных занята, повторите попытку"}
+    cache.invalidate("authors")
+    versions.bump("Authors")
+    return {"author_id": author_id, "message": "Автор создан"}
 
 @app.get("/authors/")
-def get_authors():
-    """Получить всех авторов"""
-    conn = sqlite3.connect("simple_library.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT author_id, name, bio FROM Authors")
-    authors = cursor.fetchall()
-    conn.close()
-    
-    if not authors:
-        return {"error": "Список авторов пуст"}
-    
-    return [{"author_id": a[0], "name": a[1], "bio": a[2]} for a in authors]
+async def get_authors(
+    after_id: int = 0,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: Database = Depends(get_database),
+):
+    """Получить авторов (постранично, после author_id = after_id)"""
+    async def load():
+        headers = {}
+        authors = await db.fetch_all(
+            "SELECT author_id, name, bio FROM Authors WHERE author_id > ? ORDER BY author_id LIMIT ?",
+            (after_id, limit + 1)
+        )
+        authors = paginate(headers, authors, limit)
+
+        if not authors:
+            return {"error": "Список авторов пуст"}, headers
+
+        return [{"author_id": a[0], "name": a[1], "bio": a[2]} for a in authors], headers
+
+    return await cached_json(("authors", after_id, limit), load)
 
 @app.delete("/authors/{author_id}")
-def delete_author(author_id: int):
+async def delete_author(author_id: int, db: Database = Depends(get_database)):
     """Удаление автора"""
-    conn = sqlite3.connect("simple_library.db")
-    cursor = conn.cursor()
-    try:
-        # Проверяем, есть ли книги у этого автора
+    def remove(cursor):
+        # Проверка и удаление в одной транзакции: между ними автору не добавят книгу
         cursor.execute("SELECT COUNT(*) FROM Books WHERE author_id = ?", (author_id,))
-        book_count = cursor.fetchone()[0]
-        
-        if book_count > 0:
-            return {"error": "Нельзя удалить автора, у которого есть книги"}
-        
-        # Удаляем автора
+        if cursor.fetchone()[0] > 0:
+            return None
         cursor.execute("DELETE FROM Authors WHERE author_id = ?", (author_id,))
-        conn.commit()
-        
-        if cursor.rowcount == 0:
+        return cursor.rowcount
+
+    def accept_delete(conn):
+        try:
+            deleted = write_transaction(conn, remove)
+        except sqlite3.Error as e:
+            if is_busy_error(e):
+                return {"error": "База данных занята, повторите попытку"}
+            report_db_error("delete_author", e)
+            return {"error": "Ошибка при удалении автора"}
+
+        if deleted is None:
+            return {"error": "Нельзя удалить автора, у которого есть книги"}
+        if not deleted:
             return {"error": "Автор не найден"}
-        
+
+        cache.invalidate("authors")
+        versions.bump("Authors")
+        hub.publish("author_deleted", author_id=author_id)
         return {"message": "Автор удален"}
-    except Exception as e:
-        return {"error": f"Ошибка при удалении автора: {str(e)}"}
-    finally:
-        conn.close()
+
+    return await db.write(accept_delete)
 
 # Жанры
 @app.post("/genres/")
-def create_genre(name: str, description: str = ""):
+async def create_genre(name: str, description: str = "", db: Database = Depends(get_database)):
     """Создание жанра"""
-    conn = sqlite3.connect("simple_library.db")
-    cursor = conn.cursor()
-    try:
+    def insert(cursor):
         cursor.execute("INSERT INTO Genres (name, description) VALUES (?, ?)", (name, description))
-        conn.commit()
-        genre_id = cursor.lastrowid
-        return {"genre_id": genre_id, "message": "Жанр создан"}
-    except:
+        return cursor.lastrowid
+
+    try:
+        genre_id = await db.transaction(insert)
+    except sqlite3.IntegrityError:
         return {"error": "Такой жанр уже существует"}
-    finally:
-        conn.close()
+    except sqlite3.OperationalError as e:
+        if not is_busy_error(e):
+            raise
+        return {"error": "База данных занята, повторите попытку"}
+    cache.invalidate("genres")
+    versions.bump("Genres")
+    return {"genre_id": genre_id, "message": "Жанр создан"}
 
 @app.get("/genres/")
-def get_genres():
+async def get_genres(db: Database = Depends(get_database)):
     """Получить все жанры"""
-    conn = sqlite3.connect("simple_library.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT genre_id, name, description FROM Genres")
-    genres = cursor.fetchall()
-    conn.close()
-    
-    if not genres:
-        return {"error": "Список жанров пуст"}
-    
-    return [{"genre_id": g[0], "name": g[1], "description": g[2]} for g in genres]
+    async def load():
+        genres = await db.fetch_all("SELECT genre_id, name, description FROM Genres /* full scan */")
+
+        if not genres:
+            return {"error": "Список жанров пуст"}, {}
+
+        return [{"genre_id": g[0], "name": g[1], "description": g[2]} for g in genres], {}
+
+    return await cached_json(("genres",), load)
 
 # Книги
 @app.post("/books/")
-def create_book(title: str, author_id: int, genre_id: int, isbn: str, publication_year: int, available_copies: int = 1):
+async def create_book(title: str, author_id: int, genre_id: int, isbn: str, publication_year: int, available_copies: int = 1, db: Database = Depends(get_database)):
     """Создание книги"""
-    conn = sqlite3.connect("simple_library.db")
-    cursor = conn.cursor()
-    try:
+    def insert(cursor):
         cursor.execute(
             "INSERT INTO Books (title, author_id, genre_id, isbn, publication_year, available_copies) VALUES (?, ?, ?, ?, ?, ?)",
             (title, author_id, genre_id, isbn, publication_year, available_copies)
         )
-        conn.commit()
-        book_id = cursor.lastrowid
-        return {"book_id": book_id, "message": "Книга создана"}
-    except:
+        return cursor.lastrowid
+
+    try:
+        book_id = await db.transaction(insert)
+    except sqlite3.IntegrityError:
         return {"error": "Такая книга уже существует"}
-    finally:
-        conn.close()
+    except sqlite3.OperationalError as e:
+        if not is_busy_error(e):
+            raise
+        return {"error": "База данных занята, повторите попытку"}
+    cache.invalidate("book", book_id)
+    versions.bump("Books")
+    hub.publish(
+        "book_created", book_id=book_id, title=title, author_id=author_id, genre_id=genre_id,
+        available_copies=available_copies,
+    )
+    await hub.flush(db)
+    return {"book_id": book_id, "message": "Книга создана"}
 
 @app.get("/books/")
-def get_books():
-    """Получить все книги"""
-    conn = sqlite3.connect("simple_library.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT book_id, title, author_id, genre_id, isbn, publication_year, available_copies FROM Books")
-    books = cursor.fetchall()
-    conn.close()
-    
+async def get_books(
+    request: Request,
+    response: Response,
+    after_id: int = 0,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    author_id: Optional[int] = None,
+    genre_id: Optional[int] = None,
+    year_from: Optional[int] = None,
+    year_to: Optional[int] = None,
+    available_only: bool = False,
+    db: Database = Depends(get_database),
+):
+    """Получить книги (постранично, с фильтрами по автору, жанру, году издания и наличию)"""
+    not_modified = conditional_get(request, response, "Books")
+    if not_modified:
+        return not_modified
+
+    where, params = book_filters(after_id, author_id, genre_id, year_from, year_to, available_only)
+    books = await db.fetch_all(
+        "SELECT b.book_id, b.title, b.author_id, b.genre_id, b.isbn, b.publication_year, b.available_copies FROM Books b "
+        f"WHERE {where} ORDER BY b.book_id LIMIT ?",
+        params + [limit + 1]
+    )
+    books = paginate(response.headers, books, limit)
+
     if not books:
         return {"error": "Список книг пуст"}
     
-    return [{"book_id": b[0], "title": b[1], "author_id": b[2], "genre_id": b[3], "isbn": b[4], "publication_year": b[5], "available_copies": b[6]} for b in books]
+    return rows_response(response, BOOK_COLUMNS, books)
+
+@app.get("/books/detailed")
+async def get_books_detailed(
+    request: Request,
+    response: Response,
+    after_id: int = 0,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    author_id: Optional[int] = None,
+    genre_id: Optional[int] = None,
+    year_from: Optional[int] = None,
+    year_to: Optional[int] = None,
+    available_only: bool = False,
+    db: Database = Depends(get_database),
+):
+    """Получить книги вместе с именем автора и названием жанра (те же страницы и фильтры, что у /books/)"""
+    not_modified = conditional_get(request, response, "Books", "Authors", "Genres")
+    if not_modified:
+        return not_modified
+
+    # Авторы и жанры присоединяются по первичному ключу, поэтому стоимость зависит только от размера страницы
+    where, params = book_filters(after_id, author_id, genre_id, year_from, year_to, available_only)
+    books = await db.fetch_all(
+        "SELECT b.book_id, b.title, b.author_id, a.name, b.genre_id, g.name, b.isbn, b.publication_year, b.available_copies "
+        "FROM Books b "
+        "LEFT JOIN Authors a ON a.author_id = b.author_id "
+        "LEFT JOIN Genres g ON g.genre_id = b.genre_id "
+        f"WHERE {where} ORDER BY b.book_id LIMIT ?",
+        params + [limit + 1]
+    )
+    books = paginate(response.headers, books, limit)
+
+    if not books:
+        return {"error": "Список книг пуст"}
+
+    return rows_response(response, BOOK_DETAILED_COLUMNS, books)
+
+@app.get("/books/export")
+def export_books(export_format: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$")):
+    """Потоковая выгрузка всего каталога книг (NDJSON или CSV)"""
+    return export_response(
+        "SELECT book_id, title, author_id, genre_id, isbn, publication_year, available_copies FROM Books ORDER BY book_id /* full scan */",
+        BOOK_COLUMNS,
+        export_format
+    )
+
+@app.get("/books/{book_id}")
+async def get_book(book_id: int, db: Database = Depends(get_database)):
+    """Получить книгу по идентификатору"""
+    async def load():
+        books = await db.fetch_all(
+            "SELECT book_id, title, author_id, genre_id, isbn, publication_year, available_copies FROM Books WHERE book_id = ?",
+            (book_id,)
+        )
+
+        if not books:
+            return {"error": "Книга не найдена"}, {}
+
+        b = books[0]
+        return {"book_id": b[0], "title": b[1], "author_id": b[2], "genre_id": b[3], "isbn": b[4], "publication_year": b[5], "available_copies": b[6]}, {}
+
+    return await cached_json(("book", book_id), load)
+
+@app.get("/books/{book_id}/loans")
+async def get_book_loan_history(
+    book_id: int,
+    request: Request,
+    response: Response,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    after_id: int = 0,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    include_archive: bool = False,
+    db: Database = Depends(get_database),
+):
+    """История выдач книги (постранично, с фильтром по дате выдачи, можно вместе с архивом)"""
+    return await loan_history(
+        request, response, db, "book_id", book_id, date_from, date_to, after_id, limit, include_archive
+    )
 
 # Читатели
 @app.post("/readers/")
-def create_reader(first_name: str, last_name: str, email: str, phone: str = ""):
+async def create_reader(first_name: str, last_name: str, email: str, phone: str = "", db: Database = Depends(get_database)):
     """Создание читателя"""
-    conn = sqlite3.connect("simple_library.db")
-    cursor = conn.cursor()
-    try:
+    def insert(cursor):
         cursor.execute(
             "INSERT INTO Readers (first_name, last_name, email, phone) VALUES (?, ?, ?, ?)",
             (first_name, last_name, email, phone)
         )
-        conn.commit()
-        reader_id = cursor.lastrowid
-        return {"reader_id": reader_id, "message": "Читатель создан"}
-    except:
+        return cursor.lastrowid
+
+    try:
+        reader_id = await db.transaction(insert)
+    except sqlite3.IntegrityError:
         return {"error": "Такой читатель уже существует"}
-    finally:
-        conn.close()
+    except sqlite3.OperationalError as e:
+        if not is_busy_error(e):
+            raise
+        return {"error": "База данных занята, повторите попытку"}
+    versions.bump("Readers")
+    return {"reader_id": reader_id, "message": "Читатель создан"}
 
 @app.get("/readers/")
-def get_readers():
-    """Получить всех читателей"""
-    conn = sqlite3.connect("simple_library.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT reader_id, first_name, last_name, email, phone FROM Readers")
-    readers = cursor.fetchall()
-    conn.close()
-    
+async def get_readers(
+    request: Request,
+    response: Response,
+    after_id: int = 0,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: Database = Depends(get_database),
+):
+    """Получить читателей (постранично, после reader_id = after_id)"""
+    not_modified = conditional_get(request, response, "Readers")
+    if not_modified:
+        return not_modified
+
+    readers = await db.fetch_all(
+        "SELECT reader_id, first_name, last_name, email, phone FROM Readers WHERE reader_id > ? ORDER BY reader_id LIMIT ?",
+        (after_id, limit + 1)
+    )
+    readers = paginate(response.headers, readers, limit)
+
     if not readers:
         return {"error": "Список читателей пуст"}
     
-    return [{"reader_id": r[0], "first_name": r[1], "last_name": r[2], "email": r[3], "phone": r[4]} for r in readers]
+    return rows_response(response, READER_COLUMNS, readers)
+
+@app.get("/readers/{reader_id}/loans")
+async def get_reader_loan_history(
+    reader_id: int,
+    request: Request,
+    response: Response,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    after_id: int = 0,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    include_archive: bool = False,
+    db: Database = Depends(get_database),
+):
+    """Все выдачи читателя (постранично, с фильтром по дате выдачи, можно вместе с архивом)"""
+    return await loan_history(
+        request, response, db, "reader_id", reader_id, date_from, date_to, after_id, limit, include_archive
+    )
 
 # Выдача книг
 @app.post("/book-loans/")
-def create_book_loan(book_id: int, reader_id: int, loan_date: str, due_date: str):
+async def create_book_loan(book_id: int, reader_id: int, loan_date: str, due_date: str, db: Database = Depends(get_database)):
     """Создание записи о выдаче книги"""
-    conn = sqlite3.connect("simple_library.db")
-    cursor = conn.cursor()
-    try:
-        # Проверяем доступность книги
-        cursor.execute("SELECT available_copies FROM Books WHERE book_id = ?", (book_id,))
+    loan_date, due_date = normalize_date(loan_date), normalize_date(due_date)
+    if not loan_date or not due_date:
+        return {"error": "Некорректная дата, ожидается ГГГГ-ММ-ДД"}
+
+    def checkout(cursor):
+        # Проверка наличия и списание копии - одно условное обновление, продать лишнюю копию нельзя
+        cursor.execute(
+            "UPDATE Books SET available_copies = available_copies - 1 WHERE book_id = ? AND available_copies > 0 "
+            "RETURNING available_copies",
+            (book_id,)
+        )
         book = cursor.fetchone()
-        
-        if not book or book[0] <= 0:
-            return {"error": "Книга недоступна"}
-        
+        if not book:
+            return None, None
+
         # Создаем запись о выдаче
         cursor.execute(
             "INSERT INTO BookLoans (book_id, reader_id, loan_date, due_date) VALUES (?, ?, ?, ?)",
             (book_id, reader_id, loan_date, due_date)
         )
-        
-        # Уменьшаем количество доступных копий
-        cursor.execute("UPDATE Books SET available_copies = available_copies - 1 WHERE book_id = ?", (book_id,))
-        
-        conn.commit()
-        loan_id = cursor.lastrowid
+        return cursor.lastrowid, book[0]
+
+    def issue(conn):
+        try:
+            loan_id, available_copies = write_transaction(conn, checkout)
+        except sqlite3.Error as e:
+            if is_busy_error(e):
+                return {"error": "База данных занята, повторите попытку"}
+            report_db_error("checkout", e)
+            return {"error": "Ошибка выдачи книги"}
+
+        if loan_id is None:
+            return {"error": "Книга недоступна"}
+
+        cache.invalidate("book", book_id)
+        versions.bump("Books", "BookLoans")
+        hub.publish("loan_created", loan_id=loan_id, book_id=book_id, reader_id=reader_id, available_copies=available_copies)
         return {"loan_id": loan_id, "message": "Книга выдана"}
-    except:
-        return {"error": "Ошибка выдачи книги"}
-    finally:
-        conn.close()
+
+    return await db.write(issue)
 
 @app.get("/book-loans/")
-def get_book_loans():
-    """Получить все выдачи книг"""
-    conn = sqlite3.connect("simple_library.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT loan_id, book_id, reader_id, loan_date, due_date, return_date FROM BookLoans")
-    loans = cursor.fetchall()
-    conn.close()
-    
+async def get_book_loans(
+    request: Request,
+    response: Response,
+    after_id: int = 0,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    reader_id: Optional[int] = None,
+    book_id: Optional[int] = None,
+    active_only: bool = False,
+    include_archive: bool = False,
+    db: Database = Depends(get_database),
+):
+    """Получить выдачи книг (постранично, с фильтрами по читателю, книге и невозвращенным выдачам)
+
+    include_archive=true добавляет выдачи, перенесенные в архив.
+    """
+    not_modified = conditional_get(request, response, "BookLoans")
+    if not_modified:
+        return not_modified
+
+    conditions = ["loan_id > ?"]
+    params = [after_id]
+    if reader_id is not None:
+        conditions.append("reader_id = ?")
+        params.append(reader_id)
+    if book_id is not None:
+        conditions.append("book_id = ?")
+        params.append(book_id)
+    if active_only:
+        conditions.append("return_date IS NULL")
+
+    # Без статистики планировщик берет idx_loans_reader_history и проходит всю историю читателя,
+    # а idx_loans_reader_return сразу находит его невозвращенные выдачи
+    indexes = ("idx_loans_reader_return", None) if active_only and reader_id is not None else (None, None)
+    # В архиве только возвращенные выдачи, для active_only он не нужен
+    loans = await db.fetch_all(*loans_page_query(" AND ".join(conditions), params, limit, include_archive and not active_only, indexes))
+    loans = paginate(response.headers, loans, limit)
+
     if not loans:
         return {"error": "Список выдач книг пуст"}
     
-    return [{"loan_id": l[0], "book_id": l[1], "reader_id": l[2], "loan_date": l[3], "due_date": l[4], "return_date": l[5]} for l in loans]
+    return rows_response(response, LOAN_COLUMNS, loans)
+
+@app.get("/book-loans/overdue")
+async def get_overdue_loans(
+    response: Response,
+    as_of: Optional[str] = None,
+    after_id: int = 0,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: Database = Depends(get_database),
+):
+    """Просроченные выдачи на дату as_of (по умолчанию сегодня) и их количество по читателям и книгам"""
+    as_of = normalize_date(as_of) if as_of else str(date.today())
+    if not as_of:
+        return {"error": "Некорректная дата, ожидается ГГГГ-ММ-ДД"}
+
+    # Все запросы читают только частичный индекс idx_loans_open_due, а не всю историю выдач
+    def report(conn):
+        loans = conn.execute(
+            "SELECT loan_id, book_id, reader_id, loan_date, due_date FROM BookLoans INDEXED BY idx_loans_open_due "
+            "WHERE return_date IS NULL AND due_date < ? AND loan_id > ? ORDER BY loan_id LIMIT ?",
+            (as_of, after_id, limit + 1)
+        ).fetchall()
+        by_reader = conn.execute(
+            "SELECT reader_id, COUNT(*) AS overdue FROM BookLoans INDEXED BY idx_loans_open_due "
+            "WHERE return_date IS NULL AND due_date < ? GROUP BY reader_id ORDER BY overdue DESC, reader_id LIMIT ?",
+            (as_of, limit)
+        ).fetchall()
+        by_book = conn.execute(
+            "SELECT book_id, COUNT(*) AS overdue FROM BookLoans INDEXED BY idx_loans_open_due "
+            "WHERE return_date IS NULL AND due_date < ? GROUP BY book_id ORDER BY overdue DESC, book_id LIMIT ?",
+            (as_of, limit)
+        ).fetchall()
+        total = conn.execute(
+            "SELECT COUNT(*) FROM BookLoans INDEXED BY idx_loans_open_due WHERE return_date IS NULL AND due_date < ?",
+            (as_of,)
+        ).fetchone()[0]
+        return loans, by_reader, by_book, total
+
+    loans, by_reader, by_book, total = await db.read(report)
+    loans = paginate(response.headers, loans, limit)
+
+    result = {
+        "as_of": as_of,
+        "total": total,
+        "by_reader": [{"reader_id": r[0], "overdue": r[1]} for r in by_reader],
+        "by_book": [{"book_id": b[0], "overdue": b[1]} for b in by_book],
+        "loans": [{"loan_id": l[0], "book_id": l[1], "reader_id": l[2], "loan_date": l[3], "due_date": l[4]} for l in loans],
+    }
+    return Response(content=json_bytes(result), media_type="application/json", headers=dict(response.headers))
+
+@app.get("/book-loans/export")
+def export_book_loans(export_format: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$")):
+    """Потоковая выгрузка всей истории выдач (NDJSON или CSV)"""
+    return export_response(
+        "SELECT loan_id, book_id, reader_id, loan_date, due_date, return_date FROM BookLoans ORDER BY loan_id /* full scan */",
+        LOAN_COLUMNS,
+        export_format
+    )
 
 @app.put("/book-loans/{loan_id}/return")
-def return_book(loan_id: int):
+async def return_book(loan_id: int, db: Database = Depends(get_database)):
     """Возврат книги"""
-    conn = sqlite3.connect("simple_library.db")
-    cursor = conn.cursor()
-    try:
-        # Находим выдачу
-        cursor.execute("SELECT book_id FROM BookLoans WHERE loan_id = ? AND return_date IS NULL", (loan_id,))
+    def checkin(cursor):
+        # Отмечаем возврат только невозвращенной выдачи - повторный возврат не вернет копию дважды
+        cursor.execute(
+            "UPDATE BookLoans SET return_date = ? WHERE loan_id = ? AND return_date IS NULL RETURNING book_id, reader_id",
+            (str(date.today()), loan_id)
+        )
         loan = cursor.fetchone()
-        
         if not loan:
-            return {"error": "Выдача не найдена"}
-        
-        # Отмечаем возврат
-        cursor.execute("UPDATE BookLoans SET return_date = ? WHERE loan_id = ?", (str(date.today()), loan_id))
-        
+            return None, None, None
+
         # Увеличиваем количество доступных копий
-        cursor.execute("UPDATE Books SET available_copies = available_copies + 1 WHERE book_id = ?", (loan[0],))
-        
-        conn.commit()
+        cursor.execute(
+            "UPDATE Books SET available_copies = available_copies + 1 WHERE book_id = ? RETURNING available_copies",
+            (loan[0],)
+        )
+        return loan[0], loan[1], cursor.fetchone()[0]
+
+    def accept_return(conn):
+        try:
+            book_id, reader_id, available_copies = write_transaction(conn, checkin)
+        except sqlite3.Error as e:
+            if is_busy_error(e):
+                return {"error": "База данных занята, повторите попытку"}
+            report_db_error("return", e)
+            return {"error": "Ошибка возврата книги"}
+
+        if book_id is None:
+            return {"error": "Выдача не найдена"}
+
+        cache.invalidate("book", book_id)
+        versions.bump("Books", "BookLoans")
+        hub.publish("book_returned", loan_id=loan_id, book_id=book_id, reader_id=reader_id, available_copies=available_copies)
         return {"message": "Книга возвращена"}
-    except:
-        return {"error": "Ошибка возврата книги"}
+
+    return await db.write(accept_return)
+
+@app.post("/book-loans/batch")
+async def create_book_loans_batch(request: Request, db: Database = Depends(get_database)):
+    """Выдача нескольких книг за одну транзакцию
+
+    Тело - JSON-массив (или NDJSON) объектов {book_id, reader_id, loan_date, due_date}.
+    Результат возвращается по каждой позиции в том же порядке.
+    """
+    try:
+        items = parse_records((await request.body()).decode("utf-8"))
+    except ValueError:
+        return {"error": "Некорректный JSON"}
+    if not isinstance(items, list):
+        return {"error": "Ожидается массив выдач"}
+
+    def checkout_all(cursor):
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or any(item.get(f) in (None, "") for f in ("book_id", "reader_id", "loan_date", "due_date")):
+                results[index] = {"error": "Не заполнены обязательные поля"}
+                continue
+            if not all(type(item[f]) is int for f in ("book_id", "reader_id")):
+                results[index] = {"error": "book_id и reader_id должны быть целыми числами"}
+                continue
+            item["loan_date"], item["due_date"] = normalize_date(item["loan_date"]), normalize_date(item["due_date"])
+            if not item["loan_date"] or not item["due_date"]:
+                results[index] = {"error": "Некорректная дата, ожидается ГГГГ-ММ-ДД"}
+                continue
+            valid.append(index)
+
+        # Наличие всех книг проверяется одним запросом
+        book_ids = sorted({items[i]["book_id"] for i in valid})
+        cursor.execute(
+            "SELECT book_id, available_copies FROM Books WHERE book_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(book_ids),)
+        )
+        available = dict(cursor.fetchall())
+
+        taken = {}
+        issued = []
+        for index in valid:
+            item = items[index]
+            if available.get(item["book_id"], 0) <= 0:
+                results[index] = {"error": "Книга недоступна"}
+                continue
+            available[item["book_id"]] -= 1
+            taken[item["book_id"]] = taken.get(item["book_id"], 0) + 1
+            cursor.execute(
+                "INSERT INTO BookLoans (book_id, reader_id, loan_date, due_date) VALUES (?, ?, ?, ?)",
+                (item["book_id"], item["reader_id"], item["loan_date"], item["due_date"])
+            )
+            results[index] = {"loan_id": cursor.lastrowid, "message": "Книга выдана"}
+            issued.append((cursor.lastrowid, item["book_id"], item["reader_id"], available[item["book_id"]]))
+
+        cursor.executemany(
+            "UPDATE Books SET available_copies = available_copies - ? WHERE book_id = ?",
+            [(count, book_id) for book_id, count in taken.items()]
+        )
+        return results, taken, issued
+
+    def issue_all(conn):
+        try:
+            results, taken, issued = write_transaction(conn, checkout_all)
+        except sqlite3.Error as e:
+            if is_busy_error(e):
+                return {"error": "База данных занята, повторите попытку"}
+            report_db_error("batch_checkout", e)
+            return {"error": "Ошибка выдачи книг"}
+
+        for book_id in taken:
+            cache.invalidate("book", book_id)
+        if taken:
+            versions.bump("Books", "BookLoans")
+        for loan_id, book_id, reader_id, available_copies in issued:
+            hub.publish("loan_created", loan_id=loan_id, book_id=book_id, reader_id=reader_id, available_copies=available_copies)
+        return results
+
+    return await db.write(issue_all)
+
+@app.put("/book-loans/batch-return")
+async def return_books_batch(request: Request, db: Database = Depends(get_database)):
+    """Возврат нескольких книг за одну транзакцию
+
+    Тело - JSON-массив идентификаторов выдач. Результат возвращается по каждой выдаче в том же порядке.
+    """
+    try:
+        loan_ids = json.loads((await request.body()).decode("utf-8"))
+    except ValueError:
+        return {"error": "Некорректный JSON"}
+    if not isinstance(loan_ids, list) or not all(type(i) is int for i in loan_ids):
+        return {"error": "Ожидается массив идентификаторов выдач"}
+
+    def checkin_all(cursor):
+        # Невозвращенные выдачи находятся одним запросом
+        cursor.execute(
+            "SELECT loan_id, book_id, reader_id FROM BookLoans "
+            "WHERE loan_id IN (SELECT value FROM json_each(?)) AND return_date IS NULL",
+            (json.dumps(loan_ids),)
+        )
+        open_loans = {loan_id: (book_id, reader_id) for loan_id, book_id, reader_id in cursor.fetchall()}
+
+        results = []
+        returned = {}
+        for loan_id in loan_ids:
+            loan = open_loans.pop(loan_id, None)
+            if loan is None:
+                results.append({"loan_id": loan_id, "error": "Выдача не найдена"})
+                continue
+            returned[loan_id] = loan
+            results.append({"loan_id": loan_id, "message": "Книга возвращена"})
+
+        today = str(date.today())
+        cursor.executemany(
+            "UPDATE BookLoans SET return_date = ? WHERE loan_id = ?",
+            [(today, loan_id) for loan_id in returned]
+        )
+        per_book = {}
+        for book_id, _ in returned.values():
+            per_book[book_id] = per_book.get(book_id, 0) + 1
+        cursor.executemany(
+            "UPDATE Books SET available_copies = available_copies + ? WHERE book_id = ?",
+            [(count, book_id) for book_id, count in per_book.items()]
+        )
+        # Итоговое наличие - для событий book_returned
+        cursor.execute(
+            "SELECT book_id, available_copies FROM Books WHERE book_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(per_book)),)
+        )
+        available = dict(cursor.fetchall())
+        returned = [(loan_id, book_id, reader_id, available.get(book_id)) for loan_id, (book_id, reader_id) in returned.items()]
+        return results, per_book, returned
+
+    def accept_all(conn):
+        try:
+            results, per_book, returned = write_transaction(conn, checkin_all)
+        except sqlite3.Error as e:
+            if is_busy_error(e):
+                return {"error": "База данных занята, повторите попытку"}
+            report_db_error("batch_return", e)
+            return {"error": "Ошибка возврата книг"}
+
+        for book_id in per_book:
+            cache.invalidate("book", book_id)
+        if per_book:
+            versions.bump("Books", "BookLoans")
+        for loan_id, book_id, reader_id, available_copies in returned:
+            hub.publish("book_returned", loan_id=loan_id, book_id=book_id, reader_id=reader_id, available_copies=available_copies)
+        return results
+
+    return await db.write(accept_all)
+
+@app.post("/book-loans/archive")
+async def archive_book_loans(
+    older_than_days: int = Query(ARCHIVE_AFTER_DAYS, ge=0),
+    batch_size: int = Query(ARCHIVE_BATCH_SIZE, ge=1, le=BULK_CHUNK_SIZE),
+    db: Database = Depends(get_database),
+):
+    """Перенести в архив выдачи, возвращенные больше older_than_days дней назад"""
+    try:
+        archived = await archive_loans(db, older_than_days, batch_size)
+    except sqlite3.OperationalError as e:
+        if is_busy_error(e):
+            return {"error": "База данных занята, повторите попытку"}
+        return {"error": "Ошибка архивации выдач"}
+    return {"archived": archived, "message": "Архивация завершена"}
+
+# Статистика
+@app.get("/stats")
+async def get_stats(
+    request: Request,
+    response: Response,
+    top: int = Query(10, ge=1, le=100),
+    db: Database = Depends(get_database),
+):
+    """Итоговые счетчики, самые популярные книги и выдачи по жанрам (из таблиц счетчиков)"""
+    not_modified = conditional_get(request, response, "Authors", "Genres", "Books", "Readers", "BookLoans")
+    if not_modified:
+        return not_modified
+
+    def load(conn):
+        totals = conn.execute("SELECT name, value FROM Stats /* full scan */").fetchall()
+        top_books = conn.execute(
+            "SELECT c.book_id, b.title, c.loans FROM BookLoanCounts c LEFT JOIN Books b ON b.book_id = c.book_id "
+            "ORDER BY c.loans DESC LIMIT ? /* full scan */",
+            (top,)
+        ).fetchall()
+        genres = conn.execute(
+            "SELECT c.genre_id, g.name, c.loans FROM GenreLoanCounts c LEFT JOIN Genres g ON g.genre_id = c.genre_id "
+            "ORDER BY c.loans DESC /* full scan */"
+        ).fetchall()
+        return totals, top_books, genres
+
+    totals, top_books, genres = await db.read(load)
+    return {
+        "totals": dict(totals),
+        "top_books": [{"book_id": b[0], "title": b[1], "loans": b[2]} for b in top_books],
+        "loans_by_genre": [{"genre_id": g[0], "name": g[1], "loans": g[2]} for g in genres],
+    }
+
+# Поиск
+@app.get("/search")
+async def search(
+    response: Response,
+    q: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    db: Database = Depends(get_database),
+):
+    """Полнотекстовый поиск по названиям книг, именам и биографиям авторов (по релевантности)"""
+    query = search_query(q)
+    if not query:
+        return {"error": "Пустой поисковый запрос"}
+
+    rows, truncated = await db.read(search_rows, query, limit, offset)
+    if truncated:
+        # Клиент видит, что результаты неполные, и может предложить уточнить запрос
+        response.headers["X-Search-Truncated"] = str(SEARCH_CANDIDATES)
+        if not rows:
+            return {"error": f"Слишком общий запрос: ранжированы первые {SEARCH_CANDIDATES} совпадений, уточните запрос"}
+
+    results = []
+    for rowid, title, author_name, author_bio, score in rows:
+        if rowid > 0:
+            results.append({"type": "book", "book_id": rowid, "title": title, "author": author_name, "score": -score})
+        else:
+            results.append({"type": "author", "author_id": -rowid, "name": author_name, "bio": author_bio, "score": -score})
+    return results
+
+# Массовая загрузка
+@app.post("/authors/bulk")
+async def bulk_create_authors(request: Request, db: Database = Depends(get_database)):
+    """Массовое создание авторов (JSON-массив или NDJSON)"""
+    return await bulk_import("authors", request, db)
+
+@app.post("/genres/bulk")
+async def bulk_create_genres(request: Request, db: Database = Depends(get_database)):
+    """Массовое создание жанров (JSON-массив или NDJSON)"""
+    return await bulk_import("genres", request, db)
+
+@app.post("/books/bulk")
+async def bulk_create_books(request: Request, db: Database = Depends(get_database)):
+    """Массовое создание книг (JSON-массив или NDJSON)"""
+    return await bulk_import("books", request, db)
+
+@app.post("/readers/bulk")
+async def bulk_create_readers(request: Request, db: Database = Depends(get_database)):
+    """Массовое создание читателей (JSON-массив или NDJSON)"""
+    return await bulk_import("readers", request, db)
+
+
+def import_file(kind, path):
+    """Загрузка файла (JSON-массив или NDJSON) из командной строки тем же путем, что и /{kind}/bulk"""
+    with open(path, encoding="utf-8") as f:
+        records = parse_records(f.read())
+    migrate(DB_PATH)
+    loader_pool = ConnectionPool(DB_PATH, size=1)
+    conn = loader_pool.acquire()
+    try:
+        return bulk_insert(conn, kind, records)
     finally:
-        conn.close()
+        loader_pool.release(conn)
+        loader_pool.close()
+
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="API библиотеки")
+    commands = parser.add_subparsers(dest="command")
+    serve_parser = commands.add_parser("serve", help="запустить сервер (по умолчанию)")
+    serve_parser.add_argument("--workers", type=int, default=WORKERS, help="количество процессов uvicorn")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    import_parser = commands.add_parser("import", help="загрузить записи из файла JSON/NDJSON")
+    import_parser.add_argument("kind", choices=sorted(BULK_TABLES))
+    import_parser.add_argument("path")
+    archive_parser = commands.add_parser("archive", help="перенести давно возвращенные выдачи в архив")
+    archive_parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS)
+    archive_parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    backup_parser = commands.add_parser("backup", help="сделать копию базы, не останавливая сервер")
+    backup_parser.add_argument("target", nargs="?", help="файл копии; с суффиксом .gz копия сжимается")
+    backup_parser.add_argument("--pages", type=int, default=BACKUP_PAGES, help="страниц за шаг копирования")
+    backup_parser.add_argument("--duty", type=float, default=BACKUP_DUTY, help="доля времени, которую занимает копирование")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        result = import_file(args.kind, args.path)
+        print(f"Загружено записей: {result['inserted']}, ошибок: {len(result['errors'])}")
+        for error in result["errors"]:
+            print(f"  строка {error['row']}: {error['error']}")
+    elif args.command == "archive":
+        migrate(DB_PATH)
+        archive_db = Database(ConnectionPool(DB_PATH, size=1), read_workers=1)
+        try:
+            print(f"Перенесено в архив выдач: {asyncio.run(archive_loans(archive_db, args.days, args.batch_size))}")
+        finally:
+            archive_db.close()
+    elif args.command == "backup":
+        # Метрик сервера в этом процессе нет, поэтому копирование ограничено только долей времени
+        backup = Backup(DB_PATH, args.target or backup_path(), pages=args.pages, duty=args.duty, budget=None)
+        if not backup.run():
+            raise SystemExit(f"Ошибка резервного копирования: {backup.error}")
+        stats = backup.stats()
+        print(f"Копия сохранена: {stats['target']}, страниц: {stats['pages_total']}, за {stats['duration_seconds']} с")
+    else:
+        import uvicorn
+        workers = getattr(args, "workers", WORKERS)
+        port = getattr(args, "port", 8000)
+        if workers > 1:
+            # Воркеры импортируют модуль заново и читают настройки из окружения
+            os.environ["LIBRARY_WORKERS"] = str(workers)
+            uvicorn.run(
+                "library:app", host="0.0.0.0", port=port, workers=workers, timeout_graceful_shutdown=SHUTDOWN_TIMEOUT
+            )
+        else:
+            uvicorn.run(app, host="0.0.0.0", port=port, timeout_graceful_shutdown=SHUTDOWN_TIMEOUT)
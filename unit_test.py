@@ -1,9 +1,16 @@
+import asyncio
 import unittest
+import json
+import os
+import sqlite3
 import requests
 import time
 from datetime import date, timedelta
 
 
+DB_PATH = os.environ.get("LIBRARY_DB_PATH", "simple_library.db")
+
+
 class TestLibraryAPI(unittest.TestCase):
     BASE_URL = "http://localhost:8000"
     
@@ -107,6 +114,449 @@ class TestLibraryAPI(unittest.TestCase):
         else:
             self.skipTest("Нет книг или читателей")
 
+    def test_11_health(self):
+        response = requests.get(f"{self.BASE_URL}/health")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["status"], "ok")
+
+    def test_12_get_books_page(self):
+        response = requests.get(f"{self.BASE_URL}/books/", params={'limit': 1})
+        self.assertEqual(response.status_code, 200)
+        books = response.json()
+        if not isinstance(books, list):
+            self.skipTest("Нет книг")
+        self.assertEqual(len(books), 1)
+
+        next_after_id = response.headers.get('X-Next-After-Id')
+        if next_after_id is None:
+            self.skipTest("Только одна книга")
+        self.assertEqual(int(next_after_id), books[0]['book_id'])
+        response = requests.get(f"{self.BASE_URL}/books/", params={'limit': 1, 'after_id': next_after_id})
+        self.assertGreater(response.json()[0]['book_id'], books[0]['book_id'])
+
+    def test_13_get_active_loans_of_reader(self):
+        response = requests.get(f"{self.BASE_URL}/book-loans/", params={'reader_id': 1, 'active_only': True})
+        self.assertEqual(response.status_code, 200)
+        loans = response.json()
+        if isinstance(loans, list):
+            for loan in loans:
+                self.assertEqual(loan['reader_id'], 1)
+                self.assertIsNone(loan['return_date'])
+
+    def test_14_export_books_ndjson(self):
+        response = requests.get(f"{self.BASE_URL}/books/export", params={'format': 'ndjson'})
+        self.assertEqual(response.status_code, 200)
+        for line in response.text.splitlines():
+            self.assertIn('book_id', json.loads(line))
+
+    def test_15_export_book_loans_csv(self):
+        response = requests.get(f"{self.BASE_URL}/book-loans/export", params={'format': 'csv'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.text.startswith('loan_id,book_id,reader_id'))
+
+    def test_16_bulk_create_readers(self):
+        lines = [
+            json.dumps({'first_name': 'Bulk', 'last_name': 'Reader', 'email': f'bulk{self.timestamp}@example.com'}),
+            json.dumps({'first_name': 'Bulk', 'last_name': 'Duplicate', 'email': f'bulk{self.timestamp}@example.com'}),
+            json.dumps({'first_name': 'Bulk'}),
+            json.dumps({'first_name': 'Bulk', 'last_name': 'Object', 'email': {'x': 1}}),
+        ]
+        response = requests.post(f"{self.BASE_URL}/readers/bulk", data="\n".join(lines))
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(result['inserted'], 1)
+        self.assertEqual([e['row'] for e in result['errors']], [1, 2, 3])
+        self.assertTrue(result['errors'][0]['error'].startswith('Запись уже существует'))
+
+    def test_17_get_book_after_loan_is_not_stale(self):
+        book_data = {
+            'title': f'Cached Book {self.timestamp}',
+            'author_id': 1,
+            'genre_id': 1,
+            'isbn': f'777{self.timestamp}',
+            'publication_year': 2024,
+            'available_copies': 2
+        }
+        book_id = requests.post(f"{self.BASE_URL}/books/", params=book_data).json()['book_id']
+        self.assertEqual(requests.get(f"{self.BASE_URL}/books/{book_id}").json()['available_copies'], 2)
+
+        loan_data = {
+            'book_id': book_id,
+            'reader_id': 1,
+            'loan_date': str(date.today()),
+            'due_date': str(date.today() + timedelta(days=14))
+        }
+        requests.post(f"{self.BASE_URL}/book-loans/", params=loan_data)
+        self.assertEqual(requests.get(f"{self.BASE_URL}/books/{book_id}").json()['available_copies'], 1)
+
+    def test_18_cache_stats(self):
+        requests.get(f"{self.BASE_URL}/genres/")
+        requests.get(f"{self.BASE_URL}/genres/")
+        cache = requests.get(f"{self.BASE_URL}/health").json()['cache']
+        self.assertGreater(cache['hits'], 0)
+
+    def test_19_books_conditional_get(self):
+        response = requests.get(f"{self.BASE_URL}/books/")
+        etag = response.headers['ETag']
+        response = requests.get(f"{self.BASE_URL}/books/", headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        data = {
+            'first_name': 'Etag',
+            'last_name': 'Reader',
+            'email': f'etag{self.timestamp}@example.com'
+        }
+        etag = requests.get(f"{self.BASE_URL}/readers/").headers['ETag']
+        requests.post(f"{self.BASE_URL}/readers/", params=data)
+        response = requests.get(f"{self.BASE_URL}/readers/", headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_20_search(self):
+        data = {'name': f'Фёдор Поисковый {self.timestamp}', 'bio': 'Биография'}
+        author_id = requests.post(f"{self.BASE_URL}/authors/", params=data).json()['author_id']
+
+        response = requests.get(f"{self.BASE_URL}/search", params={'q': f'федор поисков {self.timestamp}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(author_id, [r.get('author_id') for r in response.json()])
+        self.assertNotIn('X-Search-Truncated', response.headers)
+
+        requests.delete(f"{self.BASE_URL}/authors/{author_id}")
+        response = requests.get(f"{self.BASE_URL}/search", params={'q': f'федор поисков {self.timestamp}'})
+        self.assertNotIn(author_id, [r.get('author_id') for r in response.json()])
+
+    def test_21_get_books_detailed(self):
+        response = requests.get(f"{self.BASE_URL}/books/detailed", params={'limit': 5})
+        self.assertEqual(response.status_code, 200)
+        books = response.json()
+        if isinstance(books, list):
+            self.assertLessEqual(len(books), 5)
+            self.assertIn('author_name', books[0])
+            self.assertIn('genre_name', books[0])
+
+    def test_22_loan_and_return_are_not_repeated(self):
+        book_data = {
+            'title': f'Single Copy {self.timestamp}',
+            'author_id': 1,
+            'genre_id': 1,
+            'isbn': f'555{self.timestamp}',
+            'publication_year': 2024,
+            'available_copies': 1
+        }
+        book_id = requests.post(f"{self.BASE_URL}/books/", params=book_data).json()['book_id']
+        loan_data = {
+            'book_id': book_id,
+            'reader_id': 1,
+            'loan_date': str(date.today()),
+            'due_date': str(date.today() + timedelta(days=14))
+        }
+        loan_id = requests.post(f"{self.BASE_URL}/book-loans/", params=loan_data).json()['loan_id']
+        response = requests.post(f"{self.BASE_URL}/book-loans/", params=loan_data)
+        self.assertEqual(response.json(), {'error': 'Книга недоступна'})
+
+        requests.put(f"{self.BASE_URL}/book-loans/{loan_id}/return")
+        response = requests.put(f"{self.BASE_URL}/book-loans/{loan_id}/return")
+        self.assertEqual(response.json(), {'error': 'Выдача не найдена'})
+        self.assertEqual(requests.get(f"{self.BASE_URL}/books/{book_id}").json()['available_copies'], 1)
+
+    def test_23_batch_loan_and_return(self):
+        book_data = {
+            'title': f'Batch Book {self.timestamp}',
+            'author_id': 1,
+            'genre_id': 1,
+            'isbn': f'444{self.timestamp}',
+            'publication_year': 2024,
+            'available_copies': 2
+        }
+        book_id = requests.post(f"{self.BASE_URL}/books/", params=book_data).json()['book_id']
+        item = {
+            'book_id': book_id,
+            'reader_id': 1,
+            'loan_date': str(date.today()),
+            'due_date': str(date.today() + timedelta(days=14))
+        }
+        response = requests.post(f"{self.BASE_URL}/book-loans/batch", json=[item, item, item])
+        self.assertEqual(response.status_code, 200)
+        results = response.json()
+        self.assertEqual(results[2], {'error': 'Книга недоступна'})
+
+        malformed = [dict(item, book_id=str(book_id)), dict(item, reader_id=[1]), dict(item, book_id={'id': 1})]
+        response = requests.post(f"{self.BASE_URL}/book-loans/batch", json=malformed + [item])
+        self.assertEqual(response.status_code, 200)
+        rejected = response.json()
+        self.assertTrue(all('error' in r for r in rejected[:3]))
+        self.assertEqual(rejected[3], {'error': 'Книга недоступна'})
+
+        loan_ids = [r['loan_id'] for r in results if 'loan_id' in r]
+        self.assertEqual(len(loan_ids), 2)
+        response = requests.put(f"{self.BASE_URL}/book-loans/batch-return", json=loan_ids + [loan_ids[0]])
+        results = response.json()
+        self.assertEqual([('message' in r) for r in results], [True, True, False])
+        self.assertEqual(requests.get(f"{self.BASE_URL}/books/{book_id}").json()['available_copies'], 2)
+
+    def test_24_overdue_loans(self):
+        book_data = {
+            'title': f'Overdue Book {self.timestamp}',
+            'author_id': 1,
+            'genre_id': 1,
+            'isbn': f'333{self.timestamp}',
+            'publication_year': 2024,
+            'available_copies': 1
+        }
+        book_id = requests.post(f"{self.BASE_URL}/books/", params=book_data).json()['book_id']
+        loan_data = {
+            'book_id': book_id,
+            'reader_id': 1,
+            'loan_date': (date.today() - timedelta(days=30)).strftime('%d.%m.%Y'),
+            'due_date': (date.today() - timedelta(days=16)).strftime('%d.%m.%Y')
+        }
+        loan_id = requests.post(f"{self.BASE_URL}/book-loans/", params=loan_data).json()['loan_id']
+
+        response = requests.get(f"{self.BASE_URL}/book-loans/overdue", params={'limit': 1000})
+        self.assertEqual(response.status_code, 200)
+        report = response.json()
+        loan = [l for l in report['loans'] if l['loan_id'] == loan_id][0]
+        self.assertEqual(loan['due_date'], str(date.today() - timedelta(days=16)))
+        self.assertIn(book_id, [b['book_id'] for b in report['by_book']])
+
+    def test_25_stats(self):
+        before = requests.get(f"{self.BASE_URL}/stats").json()['totals']
+        data = {
+            'first_name': 'Stats',
+            'last_name': 'Reader',
+            'email': f'stats{self.timestamp}@example.com'
+        }
+        requests.post(f"{self.BASE_URL}/readers/", params=data)
+        response = requests.get(f"{self.BASE_URL}/stats")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['totals']['readers'], before['readers'] + 1)
+
+    def test_26_metrics(self):
+        requests.get(f"{self.BASE_URL}/genres/")
+        response = requests.get(f"{self.BASE_URL}/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('library_http_requests_total{method="GET",route="/genres/",status="200"}', response.text)
+        self.assertIn('library_sql_statement_duration_seconds_bucket', response.text)
+
+    def test_27_schema_migrated(self):
+        response = requests.get(f"{self.BASE_URL}/health")
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(response.json()['schema_version'], 4)
+
+    def test_28_loan_history(self):
+        book_data = {
+            'title': f'History Book {self.timestamp}',
+            'author_id': 1,
+            'genre_id': 1,
+            'isbn': f'666{self.timestamp}',
+            'publication_year': 2024,
+            'available_copies': 2
+        }
+        book_id = requests.post(f"{self.BASE_URL}/books/", params=book_data).json()['book_id']
+        loan_ids = []
+        for loan_date in ('2025-03-01', '2025-04-01'):
+            loan_data = {'book_id': book_id, 'reader_id': 1, 'loan_date': loan_date, 'due_date': '2025-05-01'}
+            loan_ids.append(requests.post(f"{self.BASE_URL}/book-loans/", params=loan_data).json()['loan_id'])
+
+        response = requests.get(f"{self.BASE_URL}/books/{book_id}/loans", params={'date_from': '2025-03-15'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([l['loan_id'] for l in response.json()], loan_ids[1:])
+
+        response = requests.get(f"{self.BASE_URL}/readers/1/loans", params={'after_id': loan_ids[0] - 1, 'limit': 1})
+        self.assertEqual([l['loan_id'] for l in response.json()], loan_ids[:1])
+        self.assertEqual(response.headers['X-Next-After-Id'], str(loan_ids[0]))
+
+    def test_29_archive_returned_loans(self):
+        book_data = {
+            'title': f'Archived Book {self.timestamp}',
+            'author_id': 1,
+            'genre_id': 1,
+            'isbn': f'222{self.timestamp}',
+            'publication_year': 2024,
+            'available_copies': 1
+        }
+        book_id = requests.post(f"{self.BASE_URL}/books/", params=book_data).json()['book_id']
+        loan_data = {'book_id': book_id, 'reader_id': 1, 'loan_date': '2025-01-10', 'due_date': '2025-01-24'}
+        loan_id = requests.post(f"{self.BASE_URL}/book-loans/", params=loan_data).json()['loan_id']
+        requests.put(f"{self.BASE_URL}/book-loans/{loan_id}/return")
+
+        response = requests.post(f"{self.BASE_URL}/book-loans/archive", params={'older_than_days': 0})
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(response.json()['archived'], 1)
+
+        self.assertIn('error', requests.get(f"{self.BASE_URL}/books/{book_id}/loans").json())
+        response = requests.get(f"{self.BASE_URL}/books/{book_id}/loans", params={'include_archive': 'true'})
+        self.assertEqual([l['loan_id'] for l in response.json()], [loan_id])
+
+    def test_30_events_stream(self):
+        book_data = {
+            'title': f'Streamed Book {self.timestamp}',
+            'author_id': 1,
+            'genre_id': 1,
+            'isbn': f'111{self.timestamp}',
+            'publication_year': 2024,
+            'available_copies': 1
+        }
+        book_id = requests.post(f"{self.BASE_URL}/books/", params=book_data).json()['book_id']
+
+        with requests.get(f"{self.BASE_URL}/events", params={'book_id': book_id}, stream=True, timeout=5) as stream:
+            self.assertEqual(stream.status_code, 200)
+            self.assertTrue(stream.headers['content-type'].startswith('text/event-stream'))
+            lines = stream.iter_lines(decode_unicode=True)
+            self.assertTrue(next(lines).startswith('retry:'))
+
+            loan_data = {'book_id': book_id, 'reader_id': 1, 'loan_date': '2025-01-10', 'due_date': '2025-01-24'}
+            loan_id = requests.post(f"{self.BASE_URL}/book-loans/", params=loan_data).json()['loan_id']
+            requests.put(f"{self.BASE_URL}/book-loans/{loan_id}/return")
+
+            events = []
+            event = None
+            for line in lines:
+                if line.startswith('event:'):
+                    event = line.split(':', 1)[1].strip()
+                elif line.startswith('data:'):
+                    events.append((event, json.loads(line.split(':', 1)[1])))
+                    if len(events) == 2:
+                        break
+
+        self.assertEqual([e[0] for e in events], ['loan_created', 'book_returned'])
+        self.assertEqual(events[0][1]['loan_id'], loan_id)
+        self.assertEqual(events[0][1]['available_copies'], 0)
+        self.assertEqual(events[1][1]['available_copies'], 1)
+
+    def test_31_hot_queries_use_indexes(self):
+        plans = requests.get(f"{self.BASE_URL}/debug/query-plans").json()
+        if not plans['plan_check']:
+            self.skipTest("сервер запущен без LIBRARY_PLAN_CHECK=1")
+
+        author_id = requests.post(f"{self.BASE_URL}/authors/", params={'name': f'Audit {self.timestamp}'}).json()['author_id']
+        requests.delete(f"{self.BASE_URL}/authors/{author_id}")
+        loan_data = {'book_id': 1, 'reader_id': 1, 'loan_date': '2025-01-10', 'due_date': '2025-01-24'}
+        loan = requests.post(f"{self.BASE_URL}/book-loans/", params=loan_data).json()
+        if 'loan_id' in loan:
+            requests.put(f"{self.BASE_URL}/book-loans/{loan['loan_id']}/return")
+
+        plans = requests.get(f"{self.BASE_URL}/debug/query-plans").json()
+        self.assertEqual(plans['full_scans'], [])
+
+    def test_32_online_backup(self):
+        response = requests.post(f"{self.BASE_URL}/admin/backup")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('target', response.json())
+
+        for _ in range(100):
+            status = requests.get(f"{self.BASE_URL}/admin/backup").json()
+            if not status['running']:
+                break
+            time.sleep(0.1)
+        self.assertFalse(status['running'])
+        self.assertIsNone(status['error'])
+        self.assertGreater(status['pages_total'], 0)
+        self.assertEqual(status['pages_done'], status['pages_total'])
+
+    def test_33_etag_sees_writes_of_other_processes(self):
+        if not os.path.exists(DB_PATH):
+            self.skipTest("база сервера не найдена в текущем каталоге")
+        etag = requests.get(f"{self.BASE_URL}/books/").headers['ETag']
+
+        # Запись в обход API, как это делает python library.py import
+        conn = sqlite3.connect(DB_PATH, timeout=5)
+        conn.execute(
+            "INSERT INTO Books (title, author_id, genre_id, isbn, publication_year, available_copies) "
+            "VALUES (?, 1, 1, ?, 2024, 1)",
+            (f'External Book {self.timestamp}', f'888{self.timestamp}')
+        )
+        conn.commit()
+        conn.close()
+
+        response = requests.get(f"{self.BASE_URL}/books/", headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_34_bulk_books_publish_events(self):
+        books = [
+            {'title': f'Bulk Event Book {self.timestamp} {i}', 'author_id': 1, 'genre_id': 1,
+             'isbn': f'000{self.timestamp}{i}', 'publication_year': 2024}
+            for i in range(2)
+        ]
+        with requests.get(f"{self.BASE_URL}/events", stream=True, timeout=5) as stream:
+            lines = stream.iter_lines(decode_unicode=True)
+            self.assertTrue(next(lines).startswith('retry:'))
+
+            response = requests.post(f"{self.BASE_URL}/books/bulk", json=books)
+            self.assertEqual(response.json()['inserted'], 2)
+
+            titles = []
+            for line in lines:
+                if line.startswith('data:'):
+                    titles.append(json.loads(line.split(':', 1)[1]).get('title'))
+                    if len(titles) == 2:
+                        break
+
+        self.assertEqual(titles, [book['title'] for book in books])
+
+    def test_35_bulk_null_uses_default(self):
+        # null в необязательном поле заменяется значением по умолчанию, а не вставляется как NULL
+        books = [{'title': f'Null Copies {self.timestamp}', 'author_id': 1, 'genre_id': 1,
+                  'isbn': f'010{self.timestamp}', 'publication_year': 2024, 'available_copies': None}]
+        result = requests.post(f"{self.BASE_URL}/books/bulk", json=books).json()
+        self.assertEqual(result, {'inserted': 1, 'errors': []})
+
+    def test_36_delete_author(self):
+        author_id = requests.post(f"{self.BASE_URL}/authors/", params={'name': f'Deleted Author {self.timestamp}'}).json()['author_id']
+        self.assertEqual(requests.delete(f"{self.BASE_URL}/authors/{author_id}").json(), {'message': 'Автор удален'})
+        self.assertEqual(requests.delete(f"{self.BASE_URL}/authors/{author_id}").json(), {'error': 'Автор не найден'})
+        # У автора 1 есть книги из предыдущих тестов
+        self.assertEqual(
+            requests.delete(f"{self.BASE_URL}/authors/1").json(), {'error': 'Нельзя удалить автора, у которого есть книги'}
+        )
+
+
+class TestGroupCommit(unittest.TestCase):
+    """Групповая фиксация Database.transaction без сервера, на временной базе"""
+
+    def setUp(self):
+        import tempfile
+        import library
+        self.library = library
+        self.dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.dir.name, "group.db")
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE Items (id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
+        conn.close()
+        self.db = library.Database(library.ConnectionPool(path, size=1), read_workers=1, group_window=0.05, group_size=10)
+
+    def tearDown(self):
+        self.db.close()
+        self.dir.cleanup()
+
+    def run_all(self, *calls):
+        async def gather():
+            return await asyncio.wait_for(asyncio.gather(*calls, return_exceptions=True), 5)
+        return asyncio.run(gather())
+
+    @staticmethod
+    def insert(cursor, *names):
+        for name in names:
+            cursor.execute("INSERT INTO Items (name) VALUES (?)", (name,))
+        return cursor.lastrowid
+
+    def test_each_caller_gets_own_result(self):
+        first, duplicate, second = self.run_all(
+            self.db.transaction(self.insert, "a"),
+            # Вторая вставка нарушает UNIQUE: откатывается и "c" из этого же вызова
+            self.db.transaction(self.insert, "c", "a"),
+            self.db.transaction(self.insert, "b"),
+        )
+        self.assertIsInstance(duplicate, sqlite3.IntegrityError)
+        self.assertNotEqual(first, second)
+        names = self.db.pool.acquire().execute("SELECT id, name FROM Items ORDER BY id").fetchall()
+        self.assertEqual(names, [(first, "a"), (second, "b")])
+
+    def test_connection_failure_reaches_every_caller(self):
+        def acquire():
+            raise sqlite3.OperationalError("unable to open database file")
+        self.db.pool.acquire = acquire
+        results = self.run_all(self.db.transaction(self.insert, "a"), self.db.transaction(self.insert, "b"))
+        self.assertTrue(all(isinstance(r, sqlite3.OperationalError) for r in results))
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file